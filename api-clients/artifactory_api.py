@@ -1,39 +1,446 @@
+import codecs
+import fnmatch
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+from datetime import datetime, timedelta, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from config_manager import ConfigManager
 
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+# base and cap of the exponential backoff between retries, in seconds
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 30
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+# (connect, read) timeouts per operation, in seconds
+DEFAULT_TIMEOUTS = {
+    "tags": (3.05, 30),
+    "property": (3.05, 30),
+    "promote": (3.05, 300),
+    "copy": (3.05, 300),
+    "aql": (3.05, 600),
+    "delete": (3.05, 60),
+}
+
+DEFAULT_AQL_PAGE_SIZE = 1000
+AQL_CHUNK_SIZE = 64 * 1024
+# unique sort key of items, keeps offset pages stable
+DEFAULT_AQL_SORT = ("repo", "path", "name")
+DEFAULT_MAX_WORKERS = 8
+MANIFEST_NAMES = ("manifest.json", "list.manifest.json")
+DIGEST_FOLDER_PREFIXES = ("sha256:", "sha256__")
+# max $or terms per AQL query
+AQL_OR_CHUNK_SIZE = 100
+DEFAULT_TAG_PAGE_SIZE = 1000
+DEFAULT_TAG_CACHE_TTL = 300
+SEMVER = re.compile(r"^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$")
+
+# Docker tag folder selected for deletion, size in bytes of every file under it
+CleanupCandidate = namedtuple("CleanupCandidate", ["repo", "image", "tag", "path", "created", "size"])
+# outcome of one item of a bulk promotion or copy, status is done, skipped or failed
+BulkResult = namedtuple("BulkResult", ["item", "status", "message"])
+
+
+def iter_json_array(chunks, key="results"):
+    """
+    Decode the items of the array under key of a streamed JSON object one by one,
+    without holding the whole body in memory.
+    :param chunks: iterable of bytes, e.g. response.iter_content()
+    :param key: name of the array member
+    :return: iterator of decoded items
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    marker = f'"{key}"'
+    buffer = ""
+    in_array = False
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        pos = 0
+        if not in_array:
+            start = buffer.find(marker)
+            if start == -1:
+                buffer = buffer[-len(marker):]
+                continue
+            pos = start + len(marker)
+            while pos < len(buffer) and buffer[pos] in " \t\r\n:":
+                pos += 1
+            if pos >= len(buffer):
+                buffer = buffer[start:]
+                continue
+            if buffer[pos] != "[":
+                raise ValueError(f"error: {key} is not an array")
+            in_array = True
+            pos += 1
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the item is not complete yet
+                break
+            if not isinstance(item, (str, list, dict)) and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                # a number may go on in the next chunk ("12" + "34", "1." + "5"), wait for its delimiter
+                break
+            pos = end
+            yield item
+        buffer = buffer[pos:]
+
+
+class RetentionPolicy:
+    """
+    Which docker tags of a repository may be deleted.
+
+    A tag is deleted only when it is not one of the keep_last newest tags of its
+    image, it is older than older_than_days and it does not carry keep_property.
+    At least one of keep_last and older_than_days is required.
+
+    Tags are the folders holding a manifest.json, or a list.manifest.json for
+    multi-arch images. The sha256 digest folders of the per-platform manifests
+    are shared by manifest lists and never selected.
+    """
+
+    def __init__(self, repo, image=None, keep_last=None, older_than_days=None, keep_property=None):
+        """
+        :param repo: docker repository
+        :param image: fnmatch pattern of the image paths, all images by default
+        :param keep_last: number of newest tags kept per image
+        :param older_than_days: only tags created before this many days are deleted
+        :param keep_property: "name" or "name=value", tags carrying it are kept
+        """
+        if keep_last is None and older_than_days is None:
+            raise ValueError("error: retention policy needs keep_last or older_than_days")
+        self.repo = repo
+        self.image = image
+        self.keep_last = keep_last
+        self.older_than_days = older_than_days
+        self.keep_property = keep_property
+
+    def criteria(self):
+        """
+        AQL criteria of the manifests of the images in scope
+        :return: dict
+        """
+        criteria = {"repo": self.repo, "$or": [{"name": name} for name in MANIFEST_NAMES]}
+        if self.image:
+            criteria["path"] = {"$match": self.image + "/*"}
+        return criteria
+
+    def protected_criteria(self):
+        """
+        AQL criteria of the manifests carrying keep_property
+        :return: dict, None without keep_property
+        """
+        if not self.keep_property:
+            return None
+        name, _, value = self.keep_property.partition("=")
+        return dict(self.criteria(), **{f"@{name}": value or {"$match": "*"}})
+
+    def select(self, tags, protected=()):
+        """
+        Tags of one image to delete
+        :param tags: list of (tag, created datetime)
+        :param protected: tags carrying keep_property
+        :return: list of (tag, created datetime)
+        """
+        tags = sorted(tags, key=lambda tag: tag[1], reverse=True)[self.keep_last or 0:]
+        cutoff = None
+        if self.older_than_days is not None:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=self.older_than_days)
+        return [(tag, created) for tag, created in tags
+                if (cutoff is None or created < cutoff) and tag not in protected]
+
+
+class RateLimiter:
+    """
+    Spaces calls evenly to at most rate per second, shared by worker threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def semver_key(tag):
+    """
+    Sort key of a semver tag, releases sort after their pre-releases
+    :param tag:
+    :return: tuple, None when the tag is not semver
+    """
+    match = SEMVER.match(tag)
+    if not match:
+        return None
+    major, minor, patch, pre = match.groups()
+    if pre is None:
+        return int(major), int(minor), int(patch), 1, ()
+    ids = tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in pre.split("."))
+    return int(major), int(minor), int(patch), 0, ids
+
+
+class DockerTagIndex:
+    """
+    Tags of docker images cached per (repo, image) for ttl seconds.
+
+    The tag listing is paged with n/last following the Link header. Every page keeps
+    its ETag, expired entries are revalidated with If-None-Match so unchanged pages
+    come back as 304 without a body.
+    """
+
+    def __init__(self, api, ttl=DEFAULT_TAG_CACHE_TTL, page_size=DEFAULT_TAG_PAGE_SIZE):
+        self.api = api
+        self.ttl = ttl
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        # (repo, image) -> (fetched at, tags, {page url: (etag, tags, next url)})
+        self._entries = {}
+
+    def _fetch(self, repo, image, pages):
+        """
+        Helper, page through the tag listing revalidating the cached pages
+        :return: (tags, pages)
+        """
+        base = self.api.host + f"/docker/{repo}"
+        url = base + f"/v2/{image}/tags/list?n={self.page_size}"
+        tags, fetched = [], {}
+        while url:
+            cached = pages.get(url)
+            headers = {"If-None-Match": cached[0]} if cached and cached[0] else {}
+            response = self.api._request("GET", url, "tags", headers=headers)
+            if response.status_code == 304:
+                page = cached
+            elif response.status_code == 404:
+                errors = response.json()
+                raise ValueError(f"{errors.get('message', errors)} {repo}")
+            else:
+                response.raise_for_status()
+                page_tags = response.json().get("tags") or []
+                next_url = response.links.get("next", {}).get("url")
+                if next_url and not next_url.startswith("http"):
+                    next_url = base + next_url
+                elif not next_url and len(page_tags) >= self.page_size:
+                    # registry without Link headers
+                    next_url = base + f"/v2/{image}/tags/list?n={self.page_size}&last={page_tags[-1]}"
+                page = (response.headers.get("ETag"), page_tags, next_url)
+            fetched[url] = page
+            tags.extend(page[1])
+            url = page[2]
+        return tags, fetched
+
+    def tags(self, repo, image, refresh=False):
+        """
+        All tags of the image
+        :param repo:
+        :param image:
+        :param refresh: revalidate even when the entry did not expire
+        :return: list of tags, raises ValueError when the image is not found
+        """
+        key = (repo, image)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and not refresh and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        tags, pages = self._fetch(repo, image, entry[2] if entry else {})
+        with self._lock:
+            self._entries[key] = (time.monotonic(), tags, pages)
+        return tags
+
+    def add(self, repo, image, tag):
+        """
+        Record a tag pushed or promoted by us, without waiting for the ttl
+        :return: None
+        """
+        with self._lock:
+            entry = self._entries.get((repo, image))
+            if entry and tag not in entry[1]:
+                self._entries[(repo, image)] = (entry[0], entry[1] + [tag], entry[2])
+
+    def invalidate(self, repo=None, image=None):
+        """
+        Forget the cached tags, of everything by default
+        :return: None
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if (repo is None or key[0] == repo) and (image is None or key[1] == image):
+                    del self._entries[key]
+
+    def _tags_or_empty(self, repo, image):
+        try:
+            return self.tags(repo, image)
+        except ValueError:
+            return []
+
+    def exists(self, repo, image, tag):
+        """
+        :return: True when the tag exists
+        """
+        return tag in self._tags_or_empty(repo, image)
+
+    def latest_semver(self, repo, image, prerelease=False):
+        """
+        Highest semver tag of the image
+        :param repo:
+        :param image:
+        :param prerelease: consider pre-release tags too
+        :return: tag or None
+        """
+        keyed = ((semver_key(tag), tag) for tag in self._tags_or_empty(repo, image))
+        keyed = [(key, tag) for key, tag in keyed if key and (prerelease or key[3])]
+        return max(keyed)[1] if keyed else None
+
+    def prefetch(self, repo, images, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Load the tags of many images concurrently
+        :return: dict of image -> set of tags, empty for unknown images
+        """
+        def fetch(image):
+            return image, set(self._tags_or_empty(repo, image))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(executor.map(fetch, set(images)))
+
+    def bulk_exists(self, repo, items, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Check many (image, tag) at once, fetching the images concurrently
+        :param repo:
+        :param items: iterable of (image, tag)
+        :param max_workers:
+        :return: dict of (image, tag) -> bool
+        """
+        items = [tuple(item) for item in items]
+        tags = self.prefetch(repo, [image for image, _ in items], max_workers)
+        return {(image, tag): tag in tags[image] for image, tag in items}
+
+
 class ArtifactoryAPI:
 
     config = ConfigManager()
 
     def __init__(self, **kwargs):
+        """
+        :param access_token: defaults to the api access-token from config
+        :param pool_size: max keep-alive connections to Artifactory
+        :param retries: max retries of idempotent calls on 429/5xx and connection errors
+        :param timeouts: dict of operation -> (connect, read) timeout overriding DEFAULT_TIMEOUTS
+        :param tag_cache_ttl: seconds the docker tag lists are cached
+        :param tag_page_size: tags per page of the docker tag listing
+        """
         self.host = self.config['artifactory']['api']['endpoint']
         self.access_token = kwargs.get('access_token', None)
         if not self.access_token:
             self.access_token = self.config['artifactory']['api']['access-token']
         self.headers = {"Authorization": f"Bearer {self.access_token}"}
+        self.retries = kwargs.get('retries', DEFAULT_RETRIES)
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **kwargs.get('timeouts', {}))
+        self.session = self._build_session(kwargs.get('pool_size', DEFAULT_POOL_SIZE))
+        self.tag_index = DockerTagIndex(self, kwargs.get('tag_cache_ttl', DEFAULT_TAG_CACHE_TTL),
+                                        kwargs.get('tag_page_size', DEFAULT_TAG_PAGE_SIZE))
 
-    def get_image_tag_list(self, repo_name, image_name):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _build_session(self, pool_size):
+        """
+        Authenticated session keeping up to pool_size connections alive
+        :param pool_size:
+        :return: requests.Session
+        """
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        """
+        Close the pooled connections
+        :return: None
+        """
+        self.session.close()
+
+    @staticmethod
+    def _backoff(attempt, retry_after=None):
+        """
+        Delay before the next attempt, Retry-After wins over the jittered exponential backoff
+        :param attempt: number of attempts done so far - 1
+        :param retry_after: Retry-After header value
+        :return: seconds
+        """
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_BACKOFF)
+        return random.uniform(0, min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** attempt))
+
+    def _request(self, method, url, operation, idempotent=None, **kwargs):
+        """
+        Send the request on the pooled session with the timeout of the operation.
+        Idempotent calls are retried on 429/5xx and connection errors.
+        :param method:
+        :param url:
+        :param operation: key of the timeouts
+        :param idempotent: defaults to True for GET, HEAD, PUT, DELETE and OPTIONS
+        :return: requests.Response
         """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeouts[operation])
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as err:
+                # a connect timeout never reached the server, it is safe to retry any call
+                retryable = idempotent or isinstance(err, requests.exceptions.ConnectTimeout)
+                if not retryable or attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if not idempotent or response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                response.close()
+            time.sleep(delay)
+            attempt += 1
 
+    def get_image_tag_list(self, repo_name, image_name):
+        """
+        All tags of the image, paged through and revalidated against the tag index
         :param repo_name:
         :param image_name:
-        :param tag_to_check:
-        :return:
+        :return: {"name": image_name, "tags": [...]}, raises ValueError when the image is not found
         """
-        url = self.host + f"/docker/{repo_name}/v2/{image_name}/tags/list"
-        response = requests.get(url, headers=self.headers)
-        try:
-            if response.status_code == 404:
-                errors = response.json()
-                if errors:
-                    raise ValueError(f"{errors['message']} {repo_name}")
-
-            elif response.status_code == 200:
-                return response.json()
-        except requests.exceptions.RequestException:
-            raise
+        return {"name": image_name, "tags": self.tag_index.tags(repo_name, image_name, refresh=True)}
 
     def set_item_property(self, repo, image, tag, **kwargs):
         """
@@ -42,7 +449,7 @@ class ArtifactoryAPI:
         product = kwargs.get('product')
         bundle_version = kwargs.get('version')
         url = self.host + f"/storage/{repo}/{image}/{tag}?properties=product={product};bundle-version={bundle_version}"
-        response = requests.put(url)
+        response = self._request("PUT", url, "property")
         if response.status_code == 204:
             print(f"info: properties updated for {image}")
 
@@ -60,20 +467,113 @@ class ArtifactoryAPI:
             "copy": copy
         }
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        # a copy can be promoted again with the same result, a move cannot: the tag is gone from the source
+        response = self._request("POST", url, "promote", idempotent=bool(copy), json=payload)
         if response.status_code == 200:
             return True, "Success"
-        return False, response.json()['errors'][0]['message']
+        try:
+            return False, response.json()['errors'][0]['message']
+        except (ValueError, KeyError, IndexError):
+            return False, f"{response.status_code} {response.reason}"
 
     def copy_artifact(self, source_repo, target_repo, object_name):
+        """
+        Copies the artifact to the same path of the target repo
+        """
+        return self._copy(source_repo, target_repo, object_name)[0]
+
+    def _copy(self, source_repo, target_repo, object_name):
+        """
+        Helper, copy the artifact
+        :return: (ok, message)
+        """
         url = self.host + f"/copy/{source_repo}/{object_name}?to={target_repo}"
-        print(url)
-      
-        response = requests.post(url, headers=self.headers)
-        print(response.json())
+
+        # copying onto the same path again gives the same result, retrying is safe
+        response = self._request("POST", url, "copy", idempotent=True)
         if response.status_code == 200:
-            return True
-        return False
+            return True, "Success"
+        try:
+            return False, response.json()['messages'][0]['message']
+        except (ValueError, KeyError, IndexError):
+            return False, f"{response.status_code} {response.reason}"
+
+    def _existing_items(self, repo, paths):
+        """
+        Helper, paths of the files or folders already in the repo, looked up with one AQL per chunk
+        :return: set of paths
+        """
+        paths = [path.strip("/") for path in paths]
+        existing = set()
+        for start in range(0, len(paths), AQL_OR_CHUNK_SIZE):
+            names = [path.rpartition("/") for path in paths[start:start + AQL_OR_CHUNK_SIZE]]
+            criteria = {"repo": repo, "type": "any",
+                        "$or": [{"path": folder or ".", "name": name} for folder, _, name in names]}
+            for item in self.iter_aql(criteria, include=["path", "name"]):
+                existing.add(item.name if item.path == "." else f"{item.path}/{item.name}")
+        return existing
+
+    @staticmethod
+    def _run_bulk(action, items, max_workers):
+        """
+        Helper, run action(item) -> (ok, message) concurrently
+        :return: list of BulkResult in the order of items
+        """
+        def run(item):
+            try:
+                ok, message = action(item)
+            except requests.exceptions.RequestException as err:
+                return BulkResult(item, "failed", str(err))
+            return BulkResult(item, "done" if ok else "failed", message)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, items))
+
+    def promote_docker_images(self, source_repo, target_repo, manifest, copy=True, skip_existing=True,
+                              max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Promote many docker images concurrently
+        :param source_repo:
+        :param target_repo:
+        :param manifest: iterable of (image, source tag, target tag)
+        :param copy: copy instead of move
+        :param skip_existing: skip target tags already in the target repo
+        :param max_workers: max promotions in parallel
+        :return: list of BulkResult in the order of the manifest
+        """
+        manifest = [tuple(item) for item in manifest]
+        existing = {}
+        if skip_existing:
+            existing = self.tag_index.prefetch(target_repo, [image for image, _, _ in manifest], max_workers)
+
+        todo = [item for item in manifest if item[2] not in existing.get(item[0], ())]
+        results = dict(zip(todo, self._run_bulk(
+            lambda item: self.promote_docker_image(source_repo, target_repo, *item, copy),
+            todo, max_workers)))
+        for item in todo:
+            if results[item].status == "done":
+                self.tag_index.add(target_repo, item[0], item[2])
+        return [results.get(item) or BulkResult(item, "skipped", f"{item[2]} already in {target_repo}")
+                for item in manifest]
+
+    def copy_artifacts(self, source_repo, target_repo, object_names, skip_existing=True,
+                       max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Copy many artifacts concurrently
+        :param source_repo:
+        :param target_repo:
+        :param object_names: iterable of artifact paths
+        :param skip_existing: skip paths already in the target repo
+        :param max_workers: max copies in parallel
+        :return: list of BulkResult in the order of object_names
+        """
+        object_names = list(object_names)
+        existing = self._existing_items(target_repo, object_names) if skip_existing else set()
+        todo = [name for name in object_names if name.strip("/") not in existing]
+        results = dict(zip(todo, self._run_bulk(
+            lambda name: self._copy(source_repo, target_repo, name), todo, max_workers)))
+        return [results.get(name) or BulkResult(name, "skipped", f"{name} already in {target_repo}")
+                for name in object_names]
 
     def aql_query(self, data):
         """
@@ -83,9 +583,214 @@ class ArtifactoryAPI:
         """
 
         url = self.host + f"/search/aql"
-        response = requests.post(url, headers=self.headers, data=data)
+        # AQL only reads, retrying it is safe
+        response = self._request("POST", url, "aql", idempotent=True, data=data)
         return response.json()
 
+    @staticmethod
+    def _aql(domain, criteria, include=None, sort=None):
+        """
+        Build the AQL query
+        :param domain: items, builds, entries...
+        :param criteria: find criteria as a dict
+        :param include: fields to return
+        :param sort: fields to sort on, ascending
+        :return: query without offset/limit
+        """
+        query = f"{domain}.find({json.dumps(criteria)})"
+        if include:
+            fields = list(include) + [field for field in sort or () if field not in include]
+            query += ".include(" + ",".join(json.dumps(field) for field in fields) + ")"
+        if sort:
+            query += ".sort(" + json.dumps({"$asc": list(sort)}) + ")"
+        return query
+
+    def iter_aql(self, criteria, domain="items", include=None, page_size=DEFAULT_AQL_PAGE_SIZE,
+                 sort=DEFAULT_AQL_SORT, keyset_field=None, records=True):
+        """
+        Stream the results of an AQL find page by page, each page is parsed
+        incrementally from the response body so only one record is decoded at a time.
+
+        Pages use .offset()/.limit() over a stable sort. With keyset_field, pages
+        continue after the last value of that field instead, which stays fast on deep
+        pages; the field must be unique (or ties at a page boundary may be skipped).
+
+            for item in arti.iter_aql({"repo": "docker-local", "type": "file"}, include=["path", "name", "size"]):
+                print(item.path, item.size)
+
+        :param criteria: find criteria as a dict
+        :param domain: items, builds, entries...
+        :param include: fields to return, records are namedtuples of these fields
+        :param page_size: results per request
+        :param sort: fields of the stable sort used by offset paging
+        :param keyset_field: unique field to page on instead of offsets
+        :param records: yield namedtuples of the include fields, dicts otherwise
+        :return: iterator of namedtuples with include and records, of dicts otherwise
+        """
+        url = self.host + "/search/aql"
+        record = namedtuple("AqlRecord", include, rename=True) if include and records else None
+        sort = [keyset_field] if keyset_field else list(sort)
+        offset = 0
+        last = None
+        while True:
+            page_criteria = criteria
+            if keyset_field and last is not None:
+                page_criteria = {"$and": [criteria, {keyset_field: {"$gt": last}}]}
+            query = self._aql(domain, page_criteria, include, sort)
+            if not keyset_field:
+                query += f".offset({offset})"
+            query += f".limit({page_size})"
+            count = 0
+            response = self._request("POST", url, "aql", idempotent=True, data=query, stream=True)
+            try:
+                response.raise_for_status()
+                for item in iter_json_array(response.iter_content(AQL_CHUNK_SIZE)):
+                    count += 1
+                    if keyset_field:
+                        last = item.get(keyset_field)
+                    yield record(*(item.get(field) for field in include)) if record else item
+            finally:
+                response.close()
+            if count < page_size:
+                return
+            offset += count
+
+    @staticmethod
+    def _parse_created(created):
+        """Helper, AQL timestamps look like 2024-01-31T10:00:00.000Z"""
+        return datetime.fromisoformat(created.replace("Z", "+00:00"))
+
+    def artifact_url(self, repo, path):
+        """
+        Url of an item in the repository, as delete_artifact expects it
+        :param repo:
+        :param path:
+        :return: url
+        """
+        base = self.host[:-len("/api")] if self.host.endswith("/api") else self.host
+        return f"{base}/{repo}/{path}"
+
+    def plan_cleanup(self, policy):
+        """
+        Evaluate the retention policy with AQL
+        :param policy: RetentionPolicy
+        :return: list of CleanupCandidate
+        """
+        def tag_folders(criteria):
+            # only fields of the items domain, AQL cannot page an include of properties
+            for item in self.iter_aql(criteria, include=["path", "created"]):
+                image, _, tag = item.path.rpartition("/")
+                if tag.startswith(DIGEST_FOLDER_PREFIXES):
+                    continue
+                if policy.image and not fnmatch.fnmatch(image, policy.image):
+                    continue
+                yield image, tag, item.created
+
+        images = {}
+        for image, tag, created in tag_folders(policy.criteria()):
+            images.setdefault(image, {})[tag] = self._parse_created(created)
+        protected = {}
+        if policy.keep_property:
+            for image, tag, _ in tag_folders(policy.protected_criteria()):
+                protected.setdefault(image, set()).add(tag)
+
+        selected = {}
+        for image, tags in images.items():
+            for tag, created in policy.select(tags.items(), protected.get(image, ())):
+                selected[f"{image}/{tag}"] = (image, tag, created)
+        if not selected:
+            return []
+
+        # size only the selected tag folders, a few of them per query
+        sizes = dict.fromkeys(selected, 0)
+        folders = sorted(selected)
+        for start in range(0, len(folders), AQL_OR_CHUNK_SIZE):
+            files = {"repo": policy.repo, "type": "file",
+                     "$or": [{"path": folder} for folder in folders[start:start + AQL_OR_CHUNK_SIZE]]}
+            for item in self.iter_aql(files, include=["path", "size"]):
+                sizes[item.path] += item.size or 0
+        return [CleanupCandidate(policy.repo, image, tag, path, created, sizes[path])
+                for path, (image, tag, created) in sorted(selected.items())]
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path):
+        """Helper, paths already deleted by a previous run"""
+        done = set()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                for line in f:
+                    if line.strip():
+                        done.add(json.loads(line)["path"])
+        return done
+
+    def execute_cleanup(self, plan, dry_run=False, max_workers=DEFAULT_MAX_WORKERS, rate=None,
+                        checkpoint_path=None):
+        """
+        Delete the planned tags concurrently
+        :param plan: list of CleanupCandidate
+        :param dry_run: only summarize the plan
+        :param max_workers: max deletes in parallel
+        :param rate: max deletes per second, unlimited when None
+        :param checkpoint_path: JSON lines log of deleted paths, they are skipped when the run is resumed
+        :return: summary dict with planned, deleted, skipped, failed, bytes_freed and errors
+        """
+        done = self._load_checkpoint(checkpoint_path)
+        todo = [candidate for candidate in plan if candidate.path not in done]
+        summary = {
+            "planned": len(plan),
+            "deleted": 0,
+            "skipped": len(plan) - len(todo),
+            "failed": 0,
+            "bytes_freed": 0,
+            "errors": [],
+            "dry_run": dry_run,
+        }
+        if dry_run:
+            summary["bytes_freed"] = sum(candidate.size for candidate in todo)
+            return summary
+
+        limiter = RateLimiter(rate)
+        log_lock = threading.Lock()
+        log = open(checkpoint_path, "a") if checkpoint_path else None
+
+        def delete(candidate):
+            limiter.wait()
+            try:
+                status = self.delete_artifact(self.artifact_url(candidate.repo, candidate.path))
+            except requests.exceptions.RequestException as err:
+                return candidate, None, err
+            if status in (200, 202, 204) and log:
+                with log_lock:
+                    log.write(json.dumps({"path": candidate.path, "size": candidate.size}) + "\n")
+                    log.flush()
+            return candidate, status, None
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for candidate, status, error in executor.map(delete, todo):
+                    if status in (200, 202, 204):
+                        summary["deleted"] += 1
+                        summary["bytes_freed"] += candidate.size
+                    elif status == 404:
+                        summary["skipped"] += 1
+                    else:
+                        summary["failed"] += 1
+                        summary["errors"].append({"path": candidate.path, "status": status, "error": str(error or "")})
+        finally:
+            if log:
+                log.close()
+        return summary
+
+    def cleanup(self, policy, dry_run=True, **kwargs):
+        """
+        Plan and run the retention policy, dry run unless asked otherwise
+        :param policy: RetentionPolicy
+        :param dry_run:
+        :param kwargs: see execute_cleanup
+        :return: summary dict
+        """
+        return self.execute_cleanup(self.plan_cleanup(policy), dry_run=dry_run, **kwargs)
+
     def delete_artifact(self, artifact_url):
         """
         Deletes the artifact from the artifactory
@@ -93,7 +798,7 @@ class ArtifactoryAPI:
         :return: status code of the delete request
         """
 
-        response = requests.delete(artifact_url, headers=self.headers)
+        response = self._request("DELETE", artifact_url, "delete")
         return response.status_code
         # if response.status_code == 204:
         #     print("info: artifact deleted")
@@ -101,8 +806,55 @@ class ArtifactoryAPI:
         # print("error: artifact deletion unsuccessful")
 
 
+def _benchmark_aql_run(mode, arti, criteria, include, queue):
+    """Helper, runs one read mode in a forked process and reports its peak RSS"""
+    # Unix only, imported here so the client itself stays importable everywhere
+    import resource
+
+    started = time.perf_counter()
+    if mode == "json":
+        count = len(arti.aql_query(arti._aql("items", criteria, include))["results"])
+    else:
+        count = sum(1 for _ in arti.iter_aql(criteria, include=include))
+    queue.put((mode, count, time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def benchmark_aql(arti, criteria, include=None):
+    """
+    Compare wall time and peak RSS of aql_query (whole body) and iter_aql (streamed), Unix only
+    :param arti: ArtifactoryAPI
+    :param criteria: items find criteria
+    :param include: fields to return
+    :return: dict of mode -> {"results", "seconds", "peak_rss_kb"}
+    """
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("fork")
+    results = {}
+    for mode in ("json", "stream"):
+        queue = ctx.Queue()
+        process = ctx.Process(target=_benchmark_aql_run, args=(mode, arti, criteria, include, queue))
+        process.start()
+        while True:
+            try:
+                _, count, seconds, peak = queue.get(timeout=1)
+                break
+            except Empty:
+                if process.is_alive():
+                    continue
+            # the child may have exited right after reporting
+            try:
+                _, count, seconds, peak = queue.get(timeout=1)
+                break
+            except Empty:
+                process.join()
+                raise RuntimeError(f"error: {mode} benchmark failed with exit code {process.exitcode}")
+        process.join()
+        results[mode] = {"results": count, "seconds": seconds, "peak_rss_kb": peak}
+    return results
+
+
 if __name__ == '__main__':
     arti = ArtifactoryAPI()
     response = arti.copy_artifact("some-local-repo", "some-local-repo-2", "image-name")
     print(response)
-
@@ -1,40 +1,1472 @@
+import base64
+import bisect
+import fnmatch
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
+
 import gitlab
+import requests
+from requests.adapters import HTTPAdapter
 from gitlab import exceptions
 from gitlab.v4.objects.projects import Project
 from config_manager import ConfigManager
 
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_PROJECT_CACHE_SIZE = 256
+DEFAULT_PROJECT_CACHE_TTL = 300
+DEFAULT_NEGATIVE_CACHE_TTL = 30
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_BLOB_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_TREE_SNAPSHOTS = 8
+# GitLab caps the number of diffs returned by compare, above this a full listing is safer
+MAX_COMPARE_DIFFS = 1000
+DEFAULT_COMMIT_ACTIONS = 500
+TRIGGER_STORE_KEY_ENV = "GITLAB_TRIGGER_STORE_KEY"
+
+# requests kept in reserve before the rate limit gate holds new work back
+DEFAULT_RATE_LIMIT_RESERVE = 10
+# longest pause the rate limit gate imposes in one go, in seconds
+MAX_RATE_LIMIT_WAIT = 60
+DEFAULT_CHECKPOINT_EVERY = 50
+
+DEFAULT_USER_REFRESH_INTERVAL = 300
+# seconds before the updated_at watermark an incremental refresh still walks, for clock skew and equal timestamps
+DEFAULT_USER_REFRESH_OVERLAP = 60
+
+PIPELINE_FINISHED = frozenset({"success", "failed", "canceled", "skipped"})
+# first poll interval (seconds) after a pipeline enters the status
+PIPELINE_POLL_INTERVALS = {
+    "created": 10,
+    "waiting_for_resource": 15,
+    "preparing": 10,
+    "pending": 10,
+    "running": 5,
+    "scheduled": 60,
+    "manual": 60,
+}
+
+# Result of one file of a bulk fetch, content is None when error is set
+FileResult = namedtuple("FileResult", ["path", "ref", "content", "error"])
+# Planned change of a CI/CD variable, action is one of create, update, delete or unchanged
+VariableChange = namedtuple("VariableChange", ["action", "key", "environment_scope", "data"])
+VariableResult = namedtuple("VariableResult", ["action", "key", "environment_scope", "ok", "error"])
+
+# State change of a watched pipeline, old_status is None for the first observation
+PipelineEvent = namedtuple("PipelineEvent", ["project", "pipeline_id", "old_status", "status", "pipeline"])
+
+# Outcome of the scan operation on one project of a group
+ScanResult = namedtuple("ScanResult", ["project_id", "project", "result", "error"])
+
+# Variable attributes compared when planning a sync
+VARIABLE_FIELDS = ("value", "variable_type", "protected", "masked", "raw", "description")
+
+
+class RateLimitGate:
+    """
+    Tracks the RateLimit-Remaining/RateLimit-Reset and Retry-After headers of
+    every response of a session and holds callers back when the budget is low.
+    """
+
+    def __init__(self, reserve=DEFAULT_RATE_LIMIT_RESERVE):
+        self.reserve = reserve
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, response, *args, **kwargs):
+        """
+        requests response hook
+        :param response:
+        :return: None
+        """
+        headers = response.headers
+        with self._lock:
+            if "RateLimit-Remaining" in headers:
+                self.remaining = int(headers["RateLimit-Remaining"])
+            if "RateLimit-Reset" in headers:
+                self.reset_at = float(headers["RateLimit-Reset"])
+            retry_after = headers.get("Retry-After")
+            if response.status_code == 429 and retry_after and retry_after.isdigit():
+                self.blocked_until = max(self.blocked_until, time.monotonic() + int(retry_after))
+
+    def delay(self):
+        """
+        Seconds to wait before sending more requests
+        :return: float
+        """
+        with self._lock:
+            delay = self.blocked_until - time.monotonic()
+            if self.remaining is not None and self.remaining <= self.reserve and self.reset_at:
+                delay = max(delay, self.reset_at - time.time())
+        return max(0.0, min(delay, MAX_RATE_LIMIT_WAIT))
+
+    def wait(self):
+        """
+        Block until the rate limit allows more requests
+        :return: None
+        """
+        delay = self.delay()
+        if delay:
+            time.sleep(delay)
+
+
+class GitlabClientPool:
+    """
+    Process wide registry of authenticated Gitlab clients.
+
+    One client (and so one keep-alive requests session) is kept per (host, token)
+    and shared by every GitlabAPI instance using the same credentials. Clients are
+    reference counted and their session is closed when the last user releases it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._refs = {}
+        self._gates = {}
+
+    @staticmethod
+    def _build_client(host, token, pool_size, gate):
+        """
+        Build a Gitlab client on top of a pooled requests session
+        :param host:
+        :param token:
+        :param pool_size: max number of keep-alive connections to the host
+        :param gate: RateLimitGate fed by the session responses
+        :return: gitlab.Gitlab
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.hooks["response"].append(gate.update)
+        return gitlab.Gitlab(url=host, private_token=token, session=session)
+
+    def acquire(self, host, token, pool_size=DEFAULT_POOL_SIZE):
+        """
+        Get the shared client for given host and token, creating it on first use.
+        The pool size is fixed by the first caller for a given (host, token).
+        :param host:
+        :param token:
+        :param pool_size:
+        :return: gitlab.Gitlab
+        """
+        key = (host, token)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self._gates[key] = RateLimitGate()
+                client = self._build_client(host, token, pool_size, self._gates[key])
+                self._clients[key] = client
+                self._refs[key] = 0
+            self._refs[key] += 1
+            return client
+
+    def release(self, host, token):
+        """
+        Drop one reference to the client, closing its session when unused
+        :param host:
+        :param token:
+        :return: None
+        """
+        key = (host, token)
+        with self._lock:
+            if key not in self._refs:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] > 0:
+                return
+            del self._refs[key]
+            del self._gates[key]
+            client = self._clients.pop(key)
+        client.session.close()
+
+    def rate_limit(self, host, token):
+        """
+        Rate limit gate of the client of given host and token
+        :return: RateLimitGate or None when there is no such client
+        """
+        with self._lock:
+            return self._gates.get((host, token))
+
+    def close_all(self):
+        """
+        Close every pooled client
+        :return: None
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._refs.clear()
+            self._gates.clear()
+        for client in clients:
+            client.session.close()
+
+
+client_pool = GitlabClientPool()
+
+
+def shift_timestamp(timestamp, seconds):
+    """
+    Move an ISO 8601 timestamp as returned by GitLab by given seconds
+    :param timestamp: e.g. 2024-01-31T10:00:00.000Z
+    :param seconds:
+    :return: ISO 8601 timestamp
+    """
+    value = datetime.fromisoformat(timestamp.replace("Z", "+00:00")) + timedelta(seconds=seconds)
+    return value.isoformat()
+
+
+def iter_list(manager, keyset=True, **kwargs):
+    """
+    Stream a list endpoint page by page.
+    Keyset pagination is asked first, endpoints (or orderings) not supporting it
+    reject the first request and the listing falls back to offset pagination.
+    :param manager: python-gitlab list manager, e.g. project.mergerequests
+    :param keyset: try keyset pagination
+    :param kwargs: filters of the endpoint
+    :return: iterator of objects
+    """
+    kwargs.setdefault("per_page", 100)
+    if keyset:
+        try:
+            items = manager.list(iterator=True, pagination="keyset", **kwargs)
+        except gitlab.exceptions.GitlabListError as err:
+            if err.response_code not in (400, 405):
+                raise
+        else:
+            yield from items
+            return
+    yield from manager.list(iterator=True, **kwargs)
+
+
+class JsonStateStore:
+    """
+    Small key/value store in a JSON file, used to keep sync watermarks between runs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._data = json.load(f)
+        except FileNotFoundError:
+            self._data = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._data, f)
+            os.replace(tmp_path, self.path)
+
+
+class ProjectCache:
+    """
+    Bounded LRU cache of resolved projects with a TTL per entry.
+
+    Projects are keyed by path ("namespace/name") and by id. Projects not found
+    are cached too (with their own, shorter TTL) so that repeated misses do not go
+    back to the server; a copy of the original error is raised on a negative hit.
+    """
+
+    def __init__(self, maxsize=DEFAULT_PROJECT_CACHE_SIZE, ttl=DEFAULT_PROJECT_CACHE_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Lookup the cached project
+        :param key: project path or id
+        :return: (found, project), raises the cached error on a negative hit
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            expires, project, error = entry
+            if error is not None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+        if error is not None:
+            # a fresh exception per caller, the cached one is shared between threads
+            raise type(error)(error.error_message, error.response_code, error.response_body)
+        return True, project
+
+    def _set(self, key, project, error, ttl):
+        self._entries[key] = (time.monotonic() + ttl, project, error)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, project, *keys):
+        """
+        Cache the project under given keys and its id
+        :param project:
+        :param keys: project path and/or id used for the lookup
+        :return: None
+        """
+        with self._lock:
+            for key in set(keys) | {project.id, project.path_with_namespace}:
+                self._set(key, project, None, self.ttl)
+
+    def put_error(self, key, error):
+        """
+        Cache a failed lookup
+        :param key:
+        :param error: exception raised by the lookup
+        :return: None
+        """
+        with self._lock:
+            self._set(key, None, error, self.negative_ttl)
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry (and its aliases) or the whole cache
+        :param key: project path or id, None to clear everything
+        :return: None
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                return
+            entry = self._entries.pop(key, None)
+            if entry and entry[1] is not None:
+                self._entries.pop(entry[1].id, None)
+                self._entries.pop(entry[1].path_with_namespace, None)
+
+    def stats(self):
+        """
+        Cache counters
+        :return: dict
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+class BlobCache:
+    """
+    Content addressed store of file contents keyed by git blob id.
+
+    A blob id is the hash of the content, so an entry never goes stale and the
+    only policy needed is size-bounded LRU eviction. This in-memory backend is
+    also the base class of DiskBlobCache, which keeps entries across runs.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_BLOB_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def blob_id(data, algorithm="sha1"):
+        """
+        Git blob id of given content
+        :param data: bytes
+        :param algorithm: sha1, or sha256 for repos using sha256 object format
+        :return: hex digest
+        """
+        h = hashlib.new(algorithm)
+        h.update(b"blob %d\0" % len(data))
+        h.update(data)
+        return h.hexdigest()
+
+    def _verify(self, blob_id, data):
+        """Helper"""
+        algorithm = "sha256" if len(blob_id) == 64 else "sha1"
+        return self.blob_id(data, algorithm) == blob_id
+
+    def _load(self, blob_id):
+        entry = self._entries.get(blob_id)
+        if entry is not None:
+            self._entries.move_to_end(blob_id)
+        return entry
+
+    def _store(self, blob_id, data):
+        self._entries[blob_id] = data
+        self._size += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, data = self._entries.popitem(last=False)
+            self._size -= len(data)
+
+    def get(self, blob_id):
+        """
+        Cached content of the blob
+        :param blob_id:
+        :return: bytes or None on a miss
+        """
+        with self._lock:
+            data = self._load(blob_id)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(data)
+            return data
+
+    def put(self, blob_id, data):
+        """
+        Store the content, ignored when it does not hash to blob_id or exceeds the cache size
+        :param blob_id:
+        :param data: bytes
+        :return: None
+        """
+        if len(data) > self.max_bytes or not self._verify(blob_id, data):
+            return
+        with self._lock:
+            if blob_id not in self._entries:
+                self._store(blob_id, data)
+
+    def stats(self):
+        """
+        Cache metrics
+        :return: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "size_bytes": self._size,
+                "entries": len(self._entries),
+            }
+
+
+class DiskBlobCache(BlobCache):
+    """
+    On-disk BlobCache, one file per blob under directory/<2 char prefix>/<blob id>.
+    The directory can be shared by CI jobs running on the same worker.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_BLOB_CACHE_BYTES):
+        super().__init__(max_bytes=max_bytes)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, blob_id):
+        return os.path.join(self.directory, blob_id[:2], blob_id)
+
+    def _scan(self):
+        """
+        Load the index (blob id -> size) of existing entries, least recently used first
+        :return: None
+        """
+        found = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                try:
+                    st = os.stat(os.path.join(prefix_dir, name))
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def _load(self, blob_id):
+        if blob_id not in self._entries:
+            return None
+        path = self._path(blob_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # removed by another process sharing the directory
+            self._size -= self._entries.pop(blob_id)
+            return None
+        self._entries.move_to_end(blob_id)
+        return data
+
+    def _store(self, blob_id, data):
+        path = self._path(blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._entries[blob_id] = len(data)
+        self._size += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            blob_id, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(blob_id))
+            except FileNotFoundError:
+                pass
+
+
+class TreeSnapshot:
+    """
+    File tree of a repository at one commit, answering path queries locally.
+    Only files (and submodules) are stored, directories are derived from them.
+    """
+
+    def __init__(self, commit_id, paths):
+        """
+        :param commit_id: commit sha the tree belongs to
+        :param paths: dict of file path -> git mode
+        """
+        self.commit_id = commit_id
+        self.modes = paths
+        self.paths = sorted(paths)
+
+    def _range(self, prefix):
+        """Helper, index range of the paths starting with prefix"""
+        start = bisect.bisect_left(self.paths, prefix)
+        # first string sorting after every string starting with prefix
+        successor = prefix.rstrip(chr(sys.maxunicode))
+        if not successor:
+            return start, len(self.paths)
+        successor = successor[:-1] + chr(ord(successor[-1]) + 1)
+        return start, bisect.bisect_left(self.paths, successor)
+
+    def exists(self, path):
+        """
+        Check if the file or directory exists
+        :param path:
+        :return: bool
+        """
+        path = path.strip("/")
+        if not path or path in self.modes:
+            return True
+        start, end = self._range(path + "/")
+        return start < end
+
+    def is_dir(self, path):
+        """
+        Check if the path is a directory
+        :param path:
+        :return: bool
+        """
+        return path.strip("/") not in self.modes and self.exists(path)
+
+    def list_prefix(self, prefix):
+        """
+        Files whose path starts with prefix, use "dir/" to list a directory recursively
+        :param prefix:
+        :return: list of paths
+        """
+        start, end = self._range(prefix.lstrip("/"))
+        return self.paths[start:end]
+
+    def glob(self, pattern):
+        """
+        Files matching the pattern segment by segment, like a shell glob:
+        "charts/*/values.yaml" does not match "charts/a/b/values.yaml"
+        :param pattern:
+        :return: list of paths
+        """
+        pattern = pattern.lstrip("/")
+        literal = len(pattern)
+        for char in "*?[":
+            index = pattern.find(char)
+            if index != -1:
+                literal = min(literal, index)
+        parts = pattern.split("/")
+        return [path for path in self.list_prefix(pattern[:literal])
+                if len(path.split("/")) == len(parts)
+                and all(fnmatch.fnmatchcase(name, part) for name, part in zip(path.split("/"), parts))]
+
+    def to_dict(self):
+        return {"commit": self.commit_id, "paths": self.modes}
+
+
+class RepositoryTreeIndex:
+    """
+    Commit keyed index of repository file trees.
+
+    The first lookup of a project lists the whole tree once. Later lookups of a
+    ref that moved only apply the compare diff between the last indexed commit
+    of that ref and the new one. With a directory, snapshots are persisted as
+    <directory>/<project>/<sha>.json next to a refs.json of last indexed commits.
+    """
+
+    def __init__(self, directory=None, max_snapshots=DEFAULT_TREE_SNAPSHOTS):
+        self.directory = directory
+        self.max_snapshots = max_snapshots
+        self._snapshots = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+        self.full_listings = 0
+        self.incremental_updates = 0
+
+    @staticmethod
+    def _project_key(project):
+        return str(project.get_id()).replace("/", "%2F")
+
+    def _project_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_refs(self, key):
+        if key in self._refs:
+            return self._refs[key]
+        refs = {}
+        if self.directory:
+            try:
+                with open(os.path.join(self._project_dir(key), "refs.json")) as f:
+                    refs = json.load(f)
+            except FileNotFoundError:
+                pass
+        self._refs[key] = refs
+        return refs
+
+    def _load_snapshot(self, key, commit_id):
+        snapshots = self._snapshots.setdefault(key, OrderedDict())
+        snapshot = snapshots.get(commit_id)
+        if snapshot is None and self.directory:
+            try:
+                with open(os.path.join(self._project_dir(key), commit_id + ".json")) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                return None
+            snapshot = TreeSnapshot(data["commit"], data["paths"])
+            self._remember(key, snapshot)
+        return snapshot
+
+    def _remember(self, key, snapshot):
+        snapshots = self._snapshots.setdefault(key, OrderedDict())
+        snapshots[snapshot.commit_id] = snapshot
+        snapshots.move_to_end(snapshot.commit_id)
+        while len(snapshots) > self.max_snapshots:
+            snapshots.popitem(last=False)
+
+    def _save(self, key, ref, snapshot, new=True):
+        refs = self._load_refs(key)
+        if not new and refs.get(ref) == snapshot.commit_id:
+            return
+        refs[ref] = snapshot.commit_id
+        self._remember(key, snapshot)
+        if not self.directory:
+            return
+        project_dir = self._project_dir(key)
+        os.makedirs(project_dir, exist_ok=True)
+        files = [("refs.json", refs)]
+        if new:
+            files.insert(0, (snapshot.commit_id + ".json", snapshot.to_dict()))
+        for name, data in files:
+            fd, tmp_path = tempfile.mkstemp(dir=project_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, os.path.join(project_dir, name))
+
+    @staticmethod
+    def _list_tree(project, commit_id):
+        """
+        Full recursive listing of the tree at given commit
+        :return: dict of path -> mode
+        """
+        paths = {}
+        for item in project.repository_tree(ref=commit_id, recursive=True, iterator=True,
+                                             pagination="keyset", per_page=100):
+            if item["type"] != "tree":
+                paths[item["path"]] = item["mode"]
+        return paths
+
+    @staticmethod
+    def _apply_compare(project, base, commit_id):
+        """
+        Build the tree at commit_id from the base snapshot and the compare diff
+        :return: dict of path -> mode, None when the diff can not be trusted
+        """
+        compare = project.repository_compare(base.commit_id, commit_id, straight=True)
+        diffs = compare.get("diffs", [])
+        if compare.get("compare_timeout") or len(diffs) >= MAX_COMPARE_DIFFS:
+            return None
+        paths = dict(base.modes)
+        for diff in diffs:
+            if diff.get("deleted_file"):
+                paths.pop(diff["old_path"], None)
+                continue
+            if diff.get("renamed_file"):
+                paths.pop(diff["old_path"], None)
+            paths[diff["new_path"]] = diff.get("b_mode") or paths.get(diff["new_path"], "100644")
+        return paths
+
+    def get(self, project, ref):
+        """
+        Tree snapshot of the ref, updated incrementally from the last indexed commit
+        :param project: Project, a lazy one is enough
+        :param ref: branch, tag or commit sha
+        :return: TreeSnapshot
+        """
+        commit_id = project.commits.get(ref).id
+        key = self._project_key(project)
+        with self._lock:
+            snapshot = self._load_snapshot(key, commit_id)
+            if snapshot is not None:
+                self._save(key, ref, snapshot, new=False)
+                return snapshot
+            refs = self._load_refs(key)
+            base_id = refs.get(ref) or next(reversed(refs.values()), None)
+            base = self._load_snapshot(key, base_id) if base_id else None
+        paths = self._apply_compare(project, base, commit_id) if base else None
+        if paths is None:
+            paths = self._list_tree(project, commit_id)
+            self.full_listings += 1
+        else:
+            self.incremental_updates += 1
+        snapshot = TreeSnapshot(commit_id, paths)
+        with self._lock:
+            self._save(key, ref, snapshot)
+        return snapshot
+
+
+class CommitBuilder:
+    """
+    Collects file actions and pushes them as one commit (commits.create with actions).
+
+    put() decides between create, update and no-op by comparing the git blob id of
+    the local content with the blob id on the branch, so unchanged files are not
+    committed. Change sets bigger than max_actions are split in a few chunked commits.
+
+        builder = gitlab_api.commit_builder("group", "manifests", "main", "Update manifests")
+        for path, content in manifests.items():
+            builder.put(path, content)
+        commit = builder.commit()
+    """
+
+    def __init__(self, project, branch, commit_message, **kwargs):
+        """
+        :param project: Project, a lazy one is enough
+        :param branch: branch to commit to
+        :param commit_message:
+        :param start_branch: branch to create branch from, if it does not exist yet
+        :param author_email:
+        :param author_name:
+        :param known_blob_ids: dict of path -> blob id on the branch, saves the HEAD lookups
+        :param max_actions: max actions per commit
+        :param max_workers: max parallel HEAD lookups
+        """
+        self.project = project
+        self.branch = branch
+        self.commit_message = commit_message
+        self.start_branch = kwargs.get('start_branch')
+        self.author_email = kwargs.get('author_email')
+        self.author_name = kwargs.get('author_name')
+        self.known_blob_ids = dict(kwargs.get('known_blob_ids') or {})
+        self.max_actions = kwargs.get('max_actions', DEFAULT_COMMIT_ACTIONS)
+        self.max_workers = kwargs.get('max_workers', DEFAULT_MAX_WORKERS)
+        self.actions = []
+        self._puts = []
+        self.skipped = []
+        self.commits = []
+
+    @staticmethod
+    def _content_action(action, file_path, content):
+        """Helper, text content is sent as is and bytes as base64"""
+        data = {'action': action, 'file_path': file_path}
+        if isinstance(content, bytes):
+            data['content'] = base64.b64encode(content).decode()
+            data['encoding'] = 'base64'
+        elif content is not None:
+            data['content'] = content
+        return data
+
+    def create(self, file_path, content):
+        self.actions.append(self._content_action('create', file_path, content))
+        return self
+
+    def update(self, file_path, content):
+        self.actions.append(self._content_action('update', file_path, content))
+        return self
+
+    def delete(self, file_path):
+        self.actions.append({'action': 'delete', 'file_path': file_path})
+        return self
+
+    def move(self, previous_path, file_path, content=None):
+        action = self._content_action('move', file_path, content)
+        action['previous_path'] = previous_path
+        self.actions.append(action)
+        return self
+
+    def put(self, file_path, content):
+        """
+        Create or update the file, skipped when the branch already has this content
+        :param file_path:
+        :param content: str or bytes
+        :return: self
+        """
+        self._puts.append((file_path, content))
+        return self
+
+    def _blob_id(self, file_path):
+        """
+        Blob id of the file on the branch
+        :return: blob id, None when the file does not exist
+        """
+        try:
+            return self.project.files.head(file_path, ref=self.start_branch or self.branch)["X-Gitlab-Blob-Id"]
+        except gitlab.exceptions.GitlabError as err:
+            if err.response_code == 404:
+                return None
+            raise
+
+    def _resolve_puts(self):
+        """
+        Turn the put() calls into create/update actions, dropping unchanged files
+        :return: None
+        """
+        unknown = {path for path, _ in self._puts if path not in self.known_blob_ids}
+        if unknown:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for path, blob_id in zip(unknown, executor.map(self._blob_id, unknown)):
+                    self.known_blob_ids[path] = blob_id
+        for file_path, content in self._puts:
+            remote_id = self.known_blob_ids.get(file_path)
+            if remote_id is None:
+                self.create(file_path, content)
+                continue
+            data = content.encode() if isinstance(content, str) else content
+            algorithm = "sha256" if len(remote_id) == 64 else "sha1"
+            if BlobCache.blob_id(data, algorithm) == remote_id:
+                self.skipped.append(file_path)
+                continue
+            self.update(file_path, content)
+        self._puts = []
+
+    def commit(self):
+        """
+        Push the collected actions
+        :return: the last created commit, None when there was nothing to commit
+        """
+        self._resolve_puts()
+        for start in range(0, len(self.actions), self.max_actions):
+            chunk = self.actions[start:start + self.max_actions]
+            data = {
+                'branch': self.branch,
+                'commit_message': self.commit_message,
+                'actions': chunk,
+            }
+            if self.start_branch and not self.commits:
+                data['start_branch'] = self.start_branch
+            if self.author_email:
+                data['author_email'] = self.author_email
+            if self.author_name:
+                data['author_name'] = self.author_name
+            self.commits.append(self.project.commits.create(data))
+        self.actions = []
+        return self.commits[-1] if self.commits else None
+
+
+class TriggerTokenCache:
+    """
+    Pipeline trigger tokens per (project, trigger description).
+
+    Tokens live in memory and, when a path is given, in a file encrypted with
+    Fernet (needs the optional cryptography package). The key is taken from the
+    GITLAB_TRIGGER_STORE_KEY environment variable when not passed explicitly,
+    generate one with cryptography.fernet.Fernet.generate_key().
+    """
+
+    def __init__(self, path=None, key=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._key_locks = {}
+        self._fernet = None
+        if path:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError:
+                raise ImportError("error: the encrypted trigger store needs the cryptography package")
+            key = key or os.environ.get(TRIGGER_STORE_KEY_ENV)
+            if not key:
+                raise ValueError(f"error: no trigger store key, set {TRIGGER_STORE_KEY_ENV}")
+            self._fernet = Fernet(key)
+            self._load()
+
+    @staticmethod
+    def _key(project, description):
+        return f"{project}|{description}"
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                self._tokens = json.loads(self._fernet.decrypt(f.read()))
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._fernet.encrypt(json.dumps(self._tokens).encode()))
+        os.replace(tmp_path, self.path)
+
+    def get(self, project, description):
+        with self._lock:
+            return self._tokens.get(self._key(project, description))
+
+    def lock(self, project, description):
+        """
+        Lock of one (project, description), held while its token is looked up or created
+        :return: threading.Lock
+        """
+        with self._lock:
+            return self._key_locks.setdefault(self._key(project, description), threading.Lock())
+
+    def put(self, project, description, token):
+        with self._lock:
+            self._tokens[self._key(project, description)] = token
+            if self._fernet:
+                self._save()
+
+    def invalidate(self, project, description):
+        with self._lock:
+            if self._tokens.pop(self._key(project, description), None) and self._fernet:
+                self._save()
+
+
+class PipelineWatcher:
+    """
+    Tracks many pipelines across projects until they finish.
+
+    Pipelines of one project are polled together with a single list request
+    filtered by updated_after, so an idle project costs one small request per
+    poll whatever the number of pipelines watched in it. Each pipeline has its
+    own interval: reset on a state change, stretched by backoff while nothing
+    changes, and aimed at the expected end of a running pipeline when its
+    expected duration is known. A project is polled when its first pipeline is due.
+
+        watcher = gitlab_api.pipeline_watcher(on_change=print)
+        watcher.watch("group", "service", pipeline.id, expected_duration=600)
+        statuses = watcher.wait_all(timeout=3600)
+    """
+
+    def __init__(self, api, **kwargs):
+        """
+        :param api: GitlabAPI
+        :param min_interval: shortest poll interval in seconds
+        :param max_interval: longest poll interval in seconds
+        :param backoff: interval multiplier while a pipeline does not change
+        :param finished: statuses considered final
+        :param on_change: callback called with every PipelineEvent
+        """
+        self.api = api
+        self.min_interval = kwargs.get('min_interval', 2)
+        self.max_interval = kwargs.get('max_interval', 120)
+        self.backoff = kwargs.get('backoff', 1.5)
+        self.finished = kwargs.get('finished', PIPELINE_FINISHED)
+        self.on_change = kwargs.get('on_change')
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._projects = {}
+        self._pipelines = {}
+
+    def watch(self, namespace, project_name, pipeline_id, expected_duration=None):
+        """
+        Start watching the pipeline
+        :param namespace:
+        :param project_name:
+        :param pipeline_id:
+        :param expected_duration: typical run time in seconds, used to space the polls
+        :return: PipelineEvent with the current status
+        """
+        path = self.api._form_project_name(namespace, project_name)
+        with self._lock:
+            if path not in self._projects:
+                project = self.api.get_project(namespace, project_name, lazy=True)
+                self._projects[path] = {"project": project, "watermark": None}
+            entry = self._projects[path]
+        pipeline = entry["project"].pipelines.get(pipeline_id)
+        self.requests += 1
+        now = time.monotonic()
+        with self._lock:
+            if entry["watermark"] is None or pipeline.updated_at < entry["watermark"]:
+                entry["watermark"] = pipeline.updated_at
+            state = {
+                "project": path,
+                "status": pipeline.status,
+                "pipeline": pipeline,
+                "expected_duration": expected_duration,
+                "started": now,
+                "interval": self._base_interval(pipeline.status),
+            }
+            state["due"] = now + state["interval"]
+            self._pipelines[(path, pipeline.id)] = state
+        return PipelineEvent(path, pipeline.id, None, pipeline.status, pipeline)
+
+    def _base_interval(self, status):
+        return max(self.min_interval, min(self.max_interval, PIPELINE_POLL_INTERVALS.get(status, self.min_interval)))
+
+    def _next_interval(self, state, changed, now):
+        """
+        Adaptive poll interval of the pipeline
+        :return: seconds
+        """
+        if changed:
+            interval = self._base_interval(state["status"])
+        else:
+            interval = state["interval"] * self.backoff
+        expected = state["expected_duration"]
+        if expected and state["status"] == "running":
+            remaining = expected - (now - state["started"])
+            interval = remaining / 2 if remaining > 0 else min(interval, self._base_interval("running"))
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def _active(self):
+        return {key: state for key, state in self._pipelines.items() if state["status"] not in self.finished}
+
+    def pending(self):
+        """
+        Watched pipelines not finished yet
+        :return: list of (project path, pipeline id)
+        """
+        with self._lock:
+            return list(self._active())
+
+    def statuses(self):
+        """
+        Last known status of every watched pipeline
+        :return: dict of (project path, pipeline id) -> status
+        """
+        with self._lock:
+            return {key: state["status"] for key, state in self._pipelines.items()}
+
+    def _poll_project(self, path, now):
+        """
+        Fetch the pipelines of the project updated since its watermark
+        :return: list of PipelineEvent
+        """
+        entry = self._projects[path]
+        # overlap of one second as updated_after is exclusive and clocks are coarse
+        updated_after = shift_timestamp(entry["watermark"], -1)
+        watched = {pid: state for (p, pid), state in self._active().items() if p == path}
+        seen = set()
+        events = []
+        self.requests += 1
+        for pipeline in entry["project"].pipelines.list(iterator=True, updated_after=updated_after,
+                                                        order_by="updated_at", sort="asc", per_page=100):
+            if pipeline.updated_at > entry["watermark"]:
+                entry["watermark"] = pipeline.updated_at
+            state = watched.get(pipeline.id)
+            if state is None or pipeline.status == state["status"]:
+                continue
+            seen.add(pipeline.id)
+            events.append(PipelineEvent(path, pipeline.id, state["status"], pipeline.status, pipeline))
+            state["status"] = pipeline.status
+            state["pipeline"] = pipeline
+        for pid, state in watched.items():
+            state["interval"] = self._next_interval(state, pid in seen, now)
+            state["due"] = now + state["interval"]
+        return events
+
+    def poll(self):
+        """
+        Poll the projects having a pipeline due, callbacks are called for every change
+        :return: list of PipelineEvent
+        """
+        now = time.monotonic()
+        with self._lock:
+            due_projects = {state["project"] for state in self._active().values() if state["due"] <= now}
+            events = []
+            for path in due_projects:
+                events.extend(self._poll_project(path, now))
+        if self.on_change:
+            for event in events:
+                self.on_change(event)
+        return events
+
+    def _next_due(self):
+        with self._lock:
+            active = self._active()
+            if not active:
+                return None
+            return min(state["due"] for state in active.values())
+
+    def events(self, timeout=None):
+        """
+        Yield the state changes until every pipeline finished or the timeout is reached
+        :param timeout: seconds, None to wait forever
+        :return: iterator of PipelineEvent
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            yield from self.poll()
+            next_due = self._next_due()
+            if next_due is None:
+                return
+            now = time.monotonic()
+            if deadline is not None:
+                if now >= deadline:
+                    return
+                next_due = min(next_due, deadline)
+            time.sleep(max(0.0, next_due - now))
+
+    def wait_all(self, timeout=None):
+        """
+        Block until every watched pipeline finished
+        :param timeout: seconds, None to wait forever
+        :return: dict of (project path, pipeline id) -> status
+        """
+        for _ in self.events(timeout=timeout):
+            pass
+        if self.pending():
+            raise TimeoutError(f"error: pipelines still running after {timeout}s: {self.pending()}")
+        return self.statuses()
+
+    def wait_any(self, timeout=None):
+        """
+        Block until one watched pipeline finished
+        :param timeout: seconds, None to wait forever
+        :return: PipelineEvent of the first finished pipeline
+        """
+        with self._lock:
+            for (path, pid), state in self._pipelines.items():
+                if state["status"] in self.finished:
+                    return PipelineEvent(path, pid, None, state["status"], state["pipeline"])
+        for event in self.events(timeout=timeout):
+            if event.status in self.finished:
+                return event
+        raise TimeoutError(f"error: no pipeline finished after {timeout}s")
+
+
+class UserDirectory:
+    """
+    Local SQLite index of GitLab users (id, username, email, name, state).
+
+    A full refresh streams every user and drops the ones that disappeared.
+    An incremental refresh walks users by most recent update and stops at the
+    first one updated before the highest updated_at of the previous refresh
+    (minus overlap seconds). That watermark is kept in the database too.
+    """
+
+    def __init__(self, path=":memory:", overlap=DEFAULT_USER_REFRESH_OVERLAP):
+        self.path = path
+        self.overlap = overlap
+        self.last_refresh = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                email TEXT,
+                name TEXT,
+                state TEXT
+            );
+            CREATE INDEX IF NOT EXISTS users_username ON users (username);
+            CREATE INDEX IF NOT EXISTS users_email ON users (email COLLATE NOCASE);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    @staticmethod
+    def _row(user):
+        return (user.id, user.username, getattr(user, "email", None), getattr(user, "name", None),
+                getattr(user, "state", None))
+
+    def _upsert(self, row):
+        """
+        Insert or update one user
+        :return: True when the row changed
+        """
+        current = self._db.execute("SELECT id, username, email, name, state FROM users WHERE id = ?",
+                                   (row[0],)).fetchone()
+        if current == row:
+            return False
+        self._db.execute("INSERT OR REPLACE INTO users (id, username, email, name, state) VALUES (?, ?, ?, ?, ?)", row)
+        return True
+
+    def refresh(self, users, full=False):
+        """
+        Update the index from a user listing
+        :param users: iterator of users, most recently updated first for an incremental refresh
+        :param full: the listing covers every user, users not in it are removed
+        :return: number of users added or changed
+        """
+        changed = 0
+        seen = set()
+        with self._lock, self._db:
+            watermark = self._db.execute("SELECT value FROM state WHERE key = 'updated_at'").fetchone()
+            watermark = self._parse_time(watermark[0]) if watermark else None
+            cutoff = watermark - timedelta(seconds=self.overlap) if watermark and not full else None
+            latest = watermark
+            for user in users:
+                # updated_at is only listed for admins, without it every user is walked
+                updated_at = self._parse_time(getattr(user, "updated_at", None))
+                if cutoff and updated_at and updated_at < cutoff:
+                    break
+                if updated_at and (latest is None or updated_at > latest):
+                    latest = updated_at
+                row = self._row(user)
+                seen.add(row[0])
+                if self._upsert(row):
+                    changed += 1
+            if full:
+                known = {user_id for (user_id,) in self._db.execute("SELECT id FROM users")}
+                self._db.executemany("DELETE FROM users WHERE id = ?", [(user_id,) for user_id in known - seen])
+            if latest and latest != watermark:
+                self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('updated_at', ?)",
+                                 (latest.isoformat(),))
+            self.last_refresh = time.time()
+        return changed
+
+    @staticmethod
+    def _parse_time(timestamp):
+        """Helper, ISO 8601 timestamp as returned by GitLab to datetime"""
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00")) if timestamp else None
+
+    def is_empty(self):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get(self, user_id):
+        """
+        :return: (id, username, email, name, state) or None
+        """
+        rows = self._query("SELECT id, username, email, name, state FROM users WHERE id = ?", (user_id,))
+        return rows[0] if rows else None
+
+    def find_by_username(self, username):
+        rows = self._query("SELECT id, username, email, name, state FROM users WHERE username = ?", (username,))
+        return rows[0] if rows else None
+
+    def find_by_email(self, email):
+        rows = self._query("SELECT id, username, email, name, state FROM users WHERE email = ? COLLATE NOCASE",
+                           (email,))
+        return rows[0] if rows else None
+
+    def emails(self, state=None):
+        """
+        Indexed emails, users without a visible email are left out
+        :param state: only users in this state, e.g. active
+        :return: list of emails
+        """
+        if state:
+            rows = self._query("SELECT email FROM users WHERE email IS NOT NULL AND state = ? ORDER BY id", (state,))
+        else:
+            rows = self._query("SELECT email FROM users WHERE email IS NOT NULL ORDER BY id")
+        return [email for (email,) in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
 class GitlabAPI:
 
     def __init__(self, **kwargs) -> None:
+        """
+        :param token: user token, defaults to the service token from config
+        :param pool_size: max keep-alive connections of the shared client
+        :param project_cache_size: max number of cached projects, 0 disables the cache
+        :param project_cache_ttl: seconds a resolved project stays cached
+        :param negative_cache_ttl: seconds a failed project lookup stays cached
+        :param lazy_projects: resolve projects without the GET when only sub-resources are used
+        :param blob_cache: BlobCache used for file reads
+        :param blob_cache_dir: directory of a DiskBlobCache, used when blob_cache is not given
+        :param blob_cache_size: max bytes kept by the DiskBlobCache
+        :param tree_index_dir: directory persisting the repository tree index
+        :param trigger_store_path: file keeping the pipeline trigger tokens, encrypted
+        :param trigger_store_key: Fernet key of the trigger store
+        :param state_store_path: JSON file keeping the incremental sync watermarks
+        :param user_directory_path: SQLite file of the local user index, enables the index
+        :param user_refresh_interval: seconds between incremental refreshes of the user index
+        """
         self.gitlab_configs = ConfigManager()['gitlab']
         self.user_token = kwargs.get('token')
+        self.pool_size = kwargs.get('pool_size', DEFAULT_POOL_SIZE)
+        self.lazy_projects = kwargs.get('lazy_projects', False)
+        self.project_cache = None
+        if kwargs.get('project_cache_size', DEFAULT_PROJECT_CACHE_SIZE):
+            self.project_cache = ProjectCache(
+                maxsize=kwargs.get('project_cache_size', DEFAULT_PROJECT_CACHE_SIZE),
+                ttl=kwargs.get('project_cache_ttl', DEFAULT_PROJECT_CACHE_TTL),
+                negative_ttl=kwargs.get('negative_cache_ttl', DEFAULT_NEGATIVE_CACHE_TTL),
+            )
+        self.blob_cache = kwargs.get('blob_cache')
+        if self.blob_cache is None and kwargs.get('blob_cache_dir'):
+            self.blob_cache = DiskBlobCache(
+                kwargs['blob_cache_dir'], max_bytes=kwargs.get('blob_cache_size', DEFAULT_BLOB_CACHE_BYTES))
+        self.tree_index = RepositoryTreeIndex(directory=kwargs.get('tree_index_dir'))
+        self.trigger_tokens = TriggerTokenCache(kwargs.get('trigger_store_path'), kwargs.get('trigger_store_key'))
+        self.state_store = None
+        if kwargs.get('state_store_path'):
+            self.state_store = JsonStateStore(kwargs['state_store_path'])
+        self.user_directory = None
+        if kwargs.get('user_directory_path'):
+            self.user_directory = UserDirectory(kwargs['user_directory_path'])
+        self.user_refresh_interval = kwargs.get('user_refresh_interval', DEFAULT_USER_REFRESH_INTERVAL)
+        self._gl = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @staticmethod
     def _form_project_name(arg1, arg2):
         """Helper"""
         return str(arg1 + "/" + arg2)
 
+    def _token(self):
+        """Helper"""
+        return self.user_token or self.gitlab_configs['auth-token']
+
+    @property
+    def rate_limit(self):
+        """
+        Rate limit gate of the shared client
+        :return: RateLimitGate
+        """
+        self.login()
+        return client_pool.rate_limit(self.gitlab_configs["host"], self._token())
+
     def login(self):
         """
-        Get the Gitlab client
+        Get the Gitlab client, shared with other instances using the same token
+        :return: gitlab.Gitlab
+        """
+        if self._gl is None:
+            with self._lock:
+                if self._gl is None:
+                    self._gl = client_pool.acquire(self.gitlab_configs["host"], self._token(), self.pool_size)
+        return self._gl
+
+    def close(self):
+        """
+        Release the shared client, the connections are closed once no instance uses them
         :return: None
         """
-        token = self.gitlab_configs['auth-token']
-        if self.user_token:
-            return gitlab.Gitlab(url=self.gitlab_configs["host"], private_token=self.user_token)
-        return gitlab.Gitlab(url=self.gitlab_configs["host"], private_token=token)
+        with self._lock:
+            if self._gl is None:
+                return
+            self._gl = None
+            client_pool.release(self.gitlab_configs["host"], self._token())
+        if self.project_cache:
+            self.project_cache.invalidate()
+
+    def iter_users(self, user_token=None, **kwargs):
+        """
+        Stream the users as pages arrive
+        :param user_token: token to list with, defaults to the one of this client
+        :param kwargs: filters, e.g. active, order_by, sort
+        :return: iterator of User
+        """
+        if not user_token or user_token == self._token():
+            yield from iter_list(self.login().users, **kwargs)
+            return
+        host = self.gitlab_configs["host"]
+        gl = client_pool.acquire(host, user_token, self.pool_size)
+        try:
+            yield from iter_list(gl.users, **kwargs)
+        finally:
+            client_pool.release(host, user_token)
 
-    def get_users_emails(self, user_token):
+    def refresh_user_directory(self, full=False, user_token=None):
+        """
+        Update the local user index, a full refresh is done when it is empty
+        :param full: re-list every user and drop the removed ones
+        :param user_token: token to list with, defaults to the one of this client
+        :return: number of users added or changed
         """
-        Gives the all user emails in list
+        if self.user_directory is None:
+            raise ValueError("error: no user directory, set user_directory_path")
+        full = full or self.user_directory.is_empty()
+        if full:
+            users = self.iter_users(user_token, order_by="id", sort="asc")
+        else:
+            users = self.iter_users(user_token, keyset=False, order_by="updated_at", sort="desc")
+        return self.user_directory.refresh(users, full=full)
+
+    def get_users_emails(self, user_token=None):
+        """
+        Gives the all user emails in list, served from the user index when configured
+        :param user_token: token to list with, defaults to the one of this client
         :return:
         """
-        user_emails = []
-        user_list = self.login().users.list(get_all=True)
-        for item in user_list:
-            user_emails.append(item.email)
-        return user_emails
+        if self.user_directory is not None:
+            if time.time() - self.user_directory.last_refresh > self.user_refresh_interval:
+                self.refresh_user_directory(user_token=user_token)
+            return self.user_directory.emails()
+        return [item.email for item in self.iter_users(user_token) if getattr(item, "email", None)]
+
+    def _cached_project_get(self, key):
+        """
+        Fetch the project by path or id, going through the project cache
+        :param key: project path or id
+        :return: Project
+        """
+        if self.project_cache is None:
+            return self.login().projects.get(key)
+        found, project = self.project_cache.get(key)
+        if found:
+            return project
+        try:
+            project = self.login().projects.get(key)
+        except gitlab.exceptions.GitlabGetError as err:
+            # only a missing project is worth remembering, 403/429/5xx may pass on the next try
+            if err.response_code == 404:
+                self.project_cache.put_error(key, err)
+            raise
+        self.project_cache.put(project, key)
+        return project
 
     def get_project_with_id(self, project_id):
         """
@@ -44,7 +1476,7 @@ class GitlabAPI:
         """
 
         try:
-            project = self.login().projects.get(project_id)
+            project = self._cached_project_get(project_id)
             return project
         except gitlab.exceptions.GitlabGetError:
             raise
@@ -57,19 +1489,25 @@ class GitlabAPI:
         :return:
         """
         try:
-            project = self.login().projects.get(self._form_project_name(namespace, project_name))
+            project = self._cached_project_get(self._form_project_name(namespace, project_name))
             return project
         except gitlab.exceptions.GitlabGetError:
             raise
 
-    def get_project(self, namespace, project_name, project_id=None):
+    def get_project(self, namespace, project_name, project_id=None, lazy=None):
         """
         Fetch the gitlab project
         :param project_id:
         :param project_name
         :param namespace
+        :param lazy: skip the GET and return a project usable for sub-resources only,
+                     defaults to the lazy_projects setting. Errors surface on first use.
         :return:
         """
+        if lazy is None:
+            lazy = self.lazy_projects
+        if lazy:
+            return self._lazy_project(namespace, project_name, project_id)
         try:
             return self.get_project_with_name(namespace, project_name)
         except gitlab.exceptions.GitlabAuthenticationError:
@@ -82,6 +1520,50 @@ class GitlabAPI:
                     raise
             raise
 
+    def _lazy_project(self, namespace, project_name, project_id=None):
+        """
+        Project handle without a server round trip, a fully cached project is preferred
+        :param namespace:
+        :param project_name:
+        :param project_id:
+        :return: Project
+        """
+        key = project_id or self._form_project_name(namespace, project_name)
+        if self.project_cache is not None:
+            try:
+                found, project = self.project_cache.get(key)
+                if found:
+                    return project
+            except gitlab.exceptions.GitlabGetError:
+                pass
+        return self.login().projects.get(key, lazy=True)
+
+    def invalidate_project(self, namespace=None, project_name=None, project_id=None):
+        """
+        Drop the project from the cache, or clear the whole cache without arguments
+        :param namespace:
+        :param project_name:
+        :param project_id:
+        :return: None
+        """
+        if self.project_cache is None:
+            return
+        if project_id is not None:
+            self.project_cache.invalidate(project_id)
+        if namespace is not None and project_name is not None:
+            self.project_cache.invalidate(self._form_project_name(namespace, project_name))
+        if project_id is None and (namespace is None or project_name is None):
+            self.project_cache.invalidate()
+
+    def project_cache_stats(self):
+        """
+        Hit/miss counters of the project cache
+        :return: dict
+        """
+        if self.project_cache is None:
+            return {}
+        return self.project_cache.stats()
+
     def is_project_exist(self, namespace, project_name, folder=None):
         """
 
@@ -89,7 +1571,7 @@ class GitlabAPI:
         :param project_name:
         :return:
         """
-        project = self.get_project(namespace, project_name)
+        project = self.get_project(namespace, project_name, lazy=False)
         if not isinstance(project, Project):
             return False
         return True
@@ -132,6 +1614,81 @@ class GitlabAPI:
         commit = project.commits.get(commit_id)
         return commit.diff(get_all=True)
 
+    @staticmethod
+    def _path_selected(paths, include, exclude):
+        """Helper, fnmatch include/exclude filtering on the old and new path of a diff"""
+        if include and not any(fnmatch.fnmatch(path, pattern) for path in paths for pattern in include):
+            return False
+        if exclude and any(fnmatch.fnmatch(path, pattern) for path in paths for pattern in exclude):
+            return False
+        return True
+
+    @staticmethod
+    def _count_lines(diff):
+        """Helper, added and removed lines of the diff of one file (hunks only, no ---/+++ headers)"""
+        added = removed = 0
+        # split on newlines only, splitlines() also breaks on form feeds and the like
+        for line in diff.split("\n"):
+            if line.startswith("+"):
+                added += 1
+            elif line.startswith("-"):
+                removed += 1
+        return added, removed
+
+    def iter_commit_diff(self, namespace, project_name, commit_id, include=None, exclude=None,
+                         max_file_bytes=None, max_total_bytes=None, stats_only=False, per_page=20):
+        """
+        Stream the commit diff file by file, one page of files in memory at a time.
+        A diff longer than max_file_bytes is cut and marked "truncated". Once
+        max_total_bytes is reached the diff being returned is cut, marked
+        "truncated" and the iteration stops.
+        :param namespace:
+        :param project_name:
+        :param commit_id:
+        :param include: fnmatch patterns, only matching paths are returned
+        :param exclude: fnmatch patterns, matching paths are skipped
+        :param max_file_bytes: cap of the diff text of one file
+        :param max_total_bytes: cap of the diff text of the whole commit
+        :param stats_only: return added/removed line counts instead of the diff text
+        :param per_page: files fetched per request
+        :return: iterator of diff dicts, with a "truncated" flag (or line counts with stats_only)
+        """
+        project = self.get_project(namespace, project_name, lazy=True)
+        commit = project.commits.get(commit_id, lazy=True)
+        total = 0
+        for item in commit.diff(iterator=True, per_page=per_page):
+            if not self._path_selected((item["old_path"], item["new_path"]), include, exclude):
+                continue
+            diff = item.get("diff") or ""
+            if stats_only:
+                added, removed = self._count_lines(diff)
+                yield {"old_path": item["old_path"], "new_path": item["new_path"], "added": added, "removed": removed}
+                continue
+            data = diff.encode()
+            limit = len(data)
+            if max_file_bytes is not None:
+                limit = min(limit, max_file_bytes)
+            if max_total_bytes is not None:
+                limit = min(limit, max_total_bytes - total)
+            item["truncated"] = limit < len(data)
+            if item["truncated"]:
+                item["diff"] = data[:limit].decode(errors="ignore")
+            total += limit
+            yield item
+            if max_total_bytes is not None and total >= max_total_bytes:
+                return
+
+    def get_commit_stats(self, namespace, project_name, commit_id):
+        """
+        Added/deleted line totals of the commit, without downloading the diff
+        :param namespace:
+        :param project_name:
+        :param commit_id:
+        :return: {"additions": int, "deletions": int, "total": int}
+        """
+        project = self.get_project(namespace, project_name, lazy=True)
+        return project.commits.get(commit_id).stats
+
     def tag_project(self, namespace, project_name, tag, branch):
         """
         tag = project.tags.create({'tag_name': '1.0', 'ref': 'main'})
@@ -151,6 +1708,80 @@ class GitlabAPI:
         project = self.get_project(namespace, project_name)
         return project.tags.list()
 
+    def scan_group(self, group, operation, include_subgroups=True, max_workers=DEFAULT_MAX_WORKERS,
+                   checkpoint=None, store=None, **filters):
+        """
+        Run operation on every project of the group (and its subgroups) concurrently.
+
+        Projects are streamed from the listing and at most 2 * max_workers are in
+        flight at any time. New work waits while GitLab reports the rate limit as
+        nearly spent. With a checkpoint name, finished projects are recorded in the
+        state store and skipped when an interrupted scan is started again.
+
+            for res in gitlab_api.scan_group("platform", lambda p: p.commits.list(ref_name="main", per_page=1)):
+                print(res.project, res.result, res.error)
+
+        :param group: group path or id
+        :param operation: callable taking a (lazy) Project, its return value is the result
+        :param include_subgroups:
+        :param max_workers: max projects processed in parallel
+        :param checkpoint: name of the scan to resume, needs a state store
+        :param store: JsonStateStore, defaults to the one of state_store_path
+        :param filters: project listing filters, e.g. archived=False
+        :return: iterator of ScanResult in completion order
+        """
+        gl = self.login()
+        gate = self.rate_limit
+        key = None
+        done = set()
+        if checkpoint:
+            store = self._require_store(store)
+            key = f"scan:{checkpoint}"
+            done = set(store.get(key) or [])
+
+        def run(group_project):
+            if gate:
+                gate.wait()
+            return operation(gl.projects.get(group_project.id, lazy=True))
+
+        projects = iter_list(gl.groups.get(group, lazy=True).projects, include_subgroups=include_subgroups,
+                             order_by="id", sort="asc", **filters)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        pending = {}
+        finished = 0
+        failed = 0
+        try:
+            while True:
+                for group_project in projects:
+                    if group_project.id in done:
+                        continue
+                    pending[executor.submit(run, group_project)] = group_project
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    group_project = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        failed += 1
+                        yield ScanResult(group_project.id, group_project.path_with_namespace, None, err)
+                        continue
+                    done.add(group_project.id)
+                    finished += 1
+                    if key and finished % DEFAULT_CHECKPOINT_EVERY == 0:
+                        store.set(key, sorted(done))
+                    yield ScanResult(group_project.id, group_project.path_with_namespace, result, None)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if key:
+                store.set(key, sorted(done))
+        if key and not failed:
+            # the scan completed, the next one starts from scratch
+            store.set(key, None)
+
     def create_commit_to_repo(self, namespace, project_name, data):
         """
         Create Gitlab commit, with given data
@@ -216,21 +1847,96 @@ class GitlabAPI:
         """
         try:
             project = self.get_project(namespace, project_name)
-            f = project.files.get(file_path=filepath, ref=branch)
-            return f.decode().decode()
+            return self._read_file(project, filepath, branch).decode()
         except gitlab.exceptions.GitlabGetError as err:
             return err
 
-    def get_repository_filetree(self, namespace, project_name, branch):
+    def _read_file(self, project, filepath, ref):
+        """
+        Fetch the raw bytes of the file, no base64 round trip.
+        With a blob cache, a HEAD request gives the current blob id and the
+        content is only downloaded when that blob is not cached yet.
+        :param project:
+        :param filepath:
+        :param ref:
+        :return: bytes
+        """
+        if self.blob_cache is None:
+            return project.files.raw(file_path=filepath, ref=ref)
+        try:
+            blob_id = project.files.head(filepath, ref=ref)["X-Gitlab-Blob-Id"]
+        except gitlab.exceptions.GitlabHeadError as err:
+            # callers expect the same error as files.raw() gives for a missing file
+            raise gitlab.exceptions.GitlabGetError(err.error_message, err.response_code, err.response_body) from err
+        data = self.blob_cache.get(blob_id)
+        if data is None:
+            data = project.repository_raw_blob(blob_id)
+            self.blob_cache.put(blob_id, data)
+        return data
+
+    def blob_cache_stats(self):
+        """
+        Hit ratio and bytes saved by the blob cache
+        :return: dict
+        """
+        if self.blob_cache is None:
+            return {}
+        return self.blob_cache.stats()
+
+    def get_files_from_repo(self, namespace, project_name, files, raw=False, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Fetch many files of the repo concurrently, the project is resolved once.
+        Keep pool_size >= max_workers so that every worker gets a pooled connection.
+        :param namespace:
+        :param project_name:
+        :param files: iterable of (filepath, ref) pairs
+        :param raw: yield bytes instead of decoded text
+        :param max_workers: max files fetched in parallel
+        :return: iterator of FileResult in completion order, errors are reported per file
+        """
+        project = self.get_project(namespace, project_name, lazy=True)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {
+                executor.submit(self._read_file, project, filepath, ref): (filepath, ref)
+                for filepath, ref in files
+            }
+            for future in as_completed(futures):
+                filepath, ref = futures[future]
+                try:
+                    content = future.result()
+                    if not raw:
+                        content = content.decode()
+                except Exception as err:
+                    # connection errors, missing headers... are reported with the file too
+                    yield FileResult(filepath, ref, None, err)
+                    continue
+                yield FileResult(filepath, ref, content, None)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_repository_filetree(self, namespace, project_name, branch, get_all=True):
         """
         Get file tree from given repo
         :param project_name:
         :param branch
         :param namespace
+        :param get_all: fetch every page, only the first page is returned otherwise
         :return:
         """
         project = self.get_project(namespace, project_name)
-        return project.repository_tree(ref=branch, recursive=True)
+        return project.repository_tree(ref=branch, recursive=True, get_all=get_all)
+
+    def get_tree_index(self, namespace, project_name, ref):
+        """
+        Indexed file tree of the ref, answers exists/prefix/glob queries locally
+        :param namespace:
+        :param project_name:
+        :param ref: branch, tag or commit sha
+        :return: TreeSnapshot
+        """
+        project = self.get_project(namespace, project_name, lazy=True)
+        return self.tree_index.get(project, ref)
 
     def get_dir_filetree(self, namespace, project_name, branch, path, get_all=False):
         """
@@ -260,6 +1966,33 @@ class GitlabAPI:
         rel_file.content = contents
         rel_file.save(branch=branch, commit_message=commit_message)
 
+    def commit_builder(self, namespace, project_name, branch, commit_message, **kwargs):
+        """
+        Start a batched multi-file commit, see CommitBuilder for the kwargs
+        :param namespace:
+        :param project_name:
+        :param branch:
+        :param commit_message:
+        :return: CommitBuilder
+        """
+        project = self.get_project(namespace, project_name, project_id=kwargs.pop('project_id', None), lazy=True)
+        return CommitBuilder(project, branch, commit_message, **kwargs)
+
+    def commit_files(self, namespace, project_name, branch, files, commit_message, **kwargs):
+        """
+        Commit many files at once, files whose content did not change are skipped
+        :param namespace:
+        :param project_name:
+        :param branch:
+        :param files: dict of file path -> content
+        :param commit_message:
+        :return: the last created commit, None when nothing changed
+        """
+        builder = self.commit_builder(namespace, project_name, branch, commit_message, **kwargs)
+        for file_path, content in files.items():
+            builder.put(file_path, content)
+        return builder.commit()
+
     def create_branch(self, namespace, project_name, branch, parent_branch):
         """
 
@@ -326,6 +2059,88 @@ class GitlabAPI:
         branches = project.branches.list(get_all=True)
         return branches
 
+    def iter_merge_requests(self, namespace, project, state=None, order_by=None, sort=None, **kwargs):
+        """
+        Stream the MRs of the given project as pages arrive
+        :param namespace:
+        :param project:
+        :param state: state of the MR. It can be one of all, merged, opened, closed or locked
+        :param order_by: sort by created_at or updated_at
+        :param sort: asc, desc
+        :param kwargs: other filters, e.g. updated_after, per_page
+        :return: iterator of ProjectMergeRequest
+        """
+        project = self.get_project(namespace, project, lazy=True)
+        filters = {name: value for name, value in (("state", state), ("order_by", order_by), ("sort", sort)) if value}
+        return iter_list(project.mergerequests, **filters, **kwargs)
+
+    def iter_branches(self, namespace, project, **kwargs):
+        """
+        Stream the branches of the given project as pages arrive
+        :param namespace:
+        :param project:
+        :param kwargs: filters, e.g. search, per_page
+        :return: iterator of ProjectBranch
+        """
+        project = self.get_project(namespace, project, lazy=True)
+        return iter_list(project.branches, **kwargs)
+
+    def _require_store(self, store):
+        """Helper"""
+        store = store or self.state_store
+        if store is None:
+            raise ValueError("error: incremental sync needs a state store, set state_store_path")
+        return store
+
+    def sync_merge_requests(self, namespace, project, state="all", store=None):
+        """
+        Yield the MRs updated since the previous sync of this project and state.
+        The watermark is saved once the iterator is exhausted, an interrupted
+        sync is simply replayed on the next run.
+        :param namespace:
+        :param project:
+        :param state: state of the MR. It can be one of all, merged, opened, closed or locked
+        :param store: JsonStateStore, defaults to the one of state_store_path
+        :return: iterator of ProjectMergeRequest
+        """
+        store = self._require_store(store)
+        key = f"merge_requests:{self._form_project_name(namespace, project)}:{state}"
+        watermark = store.get(key)
+        filters = {"order_by": "updated_at", "sort": "asc"}
+        if watermark:
+            # overlap of one second as updated_after is exclusive
+            filters["updated_after"] = shift_timestamp(watermark, -1)
+        latest = watermark
+        for mr in self.iter_merge_requests(namespace, project, state=state, **filters):
+            if watermark and mr.updated_at < watermark:
+                continue
+            if latest is None or mr.updated_at > latest:
+                latest = mr.updated_at
+            yield mr
+        if latest and latest != watermark:
+            store.set(key, latest)
+
+    def sync_branches(self, namespace, project, store=None):
+        """
+        Yield the branches created or moved since the previous sync of this project.
+        Branches have no updated_after filter, they are still streamed but only
+        the changed ones are handed to the caller.
+        :param namespace:
+        :param project:
+        :param store: JsonStateStore, defaults to the one of state_store_path
+        :return: iterator of ProjectBranch
+        """
+        store = self._require_store(store)
+        key = f"branches:{self._form_project_name(namespace, project)}"
+        known = store.get(key, {})
+        current = {}
+        for branch in self.iter_branches(namespace, project):
+            current[branch.name] = branch.commit["id"]
+            if known.get(branch.name) != current[branch.name]:
+                yield branch
+        if current != known:
+            store.set(key, current)
+
     @staticmethod
     def delete_mr(mr_obj):
         """
@@ -360,6 +2175,13 @@ class GitlabAPI:
         pipelines = project.pipelines.list(iterator=True, ref=branch)
         return pipelines
 
+    def pipeline_watcher(self, **kwargs):
+        """
+        Watcher tracking many pipelines at once, see PipelineWatcher for the kwargs
+        :return: PipelineWatcher
+        """
+        return PipelineWatcher(self, **kwargs)
+
     def has_project_variable(self, namespace, project_name, key):
         """
         Check if a CI/CD variable already exists in a GitLab project.
@@ -385,15 +2207,18 @@ class GitlabAPI:
         :return: True if all variables are added successfully or already exist, False otherwise
         """
         try:
-            project = self.get_project(namespace, project_name)
+            project = self.get_project(namespace, project_name, lazy=True)
+            existing_keys = {variable.key for variable in project.variables.list(iterator=True)}
             for variable_data in variables:
 
                 key = variable_data['key']
 
-                if not self.has_project_variable(project, key):
+                if key not in existing_keys:
+                    variable_data = dict(variable_data)
                     variable_data['environment_scope'] = variable_data.get('environment_scope', None)
                     variable_data['protected'] = variable_data.get('protected', False)
                     project.variables.create(variable_data)
+                    existing_keys.add(key)
 
                     print(f"Variable '{key}' added successfully to project '{namespace}/{project_name}'.")
                 else:
@@ -403,7 +2228,85 @@ class GitlabAPI:
         except gitlab.exceptions.GitlabCreateError as err:
             print(f"Failed to add variables: {err}")
             return False
-        
+
+    @staticmethod
+    def plan_project_variables(existing, variables, delete_missing=False):
+        """
+        Compute the changes turning the existing variables into the wanted ones
+        :param existing: listed project variables
+        :param variables: list of variable definitions, each with key and value at least
+        :param delete_missing: delete variables that are not in the wanted list
+        :return: list of VariableChange
+        """
+        index = {(v.key, getattr(v, 'environment_scope', '*')): v for v in existing}
+        plan = []
+        wanted = set()
+        for variable_data in variables:
+            scope = variable_data.get('environment_scope') or '*'
+            key = (variable_data['key'], scope)
+            wanted.add(key)
+            current = index.get(key)
+            if current is None:
+                plan.append(VariableChange('create', key[0], scope, dict(variable_data, environment_scope=scope)))
+                continue
+            changed = {
+                field: variable_data[field] for field in VARIABLE_FIELDS
+                if field in variable_data and getattr(current, field, None) != variable_data[field]
+            }
+            if not changed:
+                plan.append(VariableChange('unchanged', key[0], scope, {}))
+                continue
+            # the update endpoint requires value, the scope picks the variable to update
+            changed.update(value=variable_data['value'], environment_scope=scope)
+            plan.append(VariableChange('update', key[0], scope, changed))
+        if delete_missing:
+            for key in index:
+                if key not in wanted:
+                    plan.append(VariableChange('delete', key[0], key[1], {}))
+        return plan
+
+    @staticmethod
+    def _apply_variable_change(project, change):
+        """
+        Apply one planned change
+        :return: VariableResult
+        """
+        scope_filter = {'environment_scope': change.environment_scope}
+        try:
+            if change.action == 'create':
+                project.variables.create(change.data)
+            elif change.action == 'update':
+                project.variables.update(change.key, change.data, filter=scope_filter)
+            elif change.action == 'delete':
+                project.variables.delete(change.key, filter=scope_filter)
+        except Exception as err:
+            # every change gets its result, one failure must not hide the others
+            return VariableResult(change.action, change.key, change.environment_scope, False, err)
+        return VariableResult(change.action, change.key, change.environment_scope, True, None)
+
+    def sync_project_variables(self, namespace, project_name, variables, delete_missing=False, dry_run=False,
+                               max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Make the project CI/CD variables match the given definitions.
+        Variables are listed once and matched on (key, environment_scope), then only
+        the needed creates/updates/deletes are sent, in parallel.
+        :param namespace:
+        :param project_name:
+        :param variables: list of variable definitions, each with key and value at least
+        :param delete_missing: delete project variables that are not in the list
+        :param dry_run: only compute the plan
+        :param max_workers: max changes applied in parallel
+        :return: {"plan": [VariableChange], "results": [VariableResult]}
+        """
+        project = self.get_project(namespace, project_name, lazy=True)
+        plan = self.plan_project_variables(project.variables.list(iterator=True), variables, delete_missing)
+        changes = [change for change in plan if change.action != 'unchanged']
+        if dry_run or not changes:
+            return {"plan": plan, "results": []}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda change: self._apply_variable_change(project, change), changes))
+        return {"plan": plan, "results": results}
+
     def lock_branch(self, namespace, project_name, branch):
         """
         Lock the branch
@@ -414,12 +2317,68 @@ class GitlabAPI:
 
     def run_pipeline(self, namespace, project, branch, trigger='Accelerator', parameters=None):
         """
-        Run the pipeline
+        Run the pipeline, the trigger token is cached so a warm call is a single request
+        :return: ProjectPipeline
         """
-        trigger = self.get_or_create_trigger(namespace, project, trigger)
-        project = self.get_project(namespace, project)
-        pipeline = project.trigger_pipeline(ref=branch, token=trigger.token, variables=parameters)
+        project_path = self._form_project_name(namespace, project)
+        project = self.get_project(namespace, project, lazy=True)
+        pipeline = self._trigger_pipeline(project, project_path, branch, trigger, parameters)
         print(f"Pipeline triggered: {pipeline.web_url}")
+        return pipeline
+
+    def _trigger_pipeline(self, project, project_path, branch, trigger, parameters):
+        """
+        Trigger with the cached token, refreshing it once when GitLab rejects it as stale
+        :return: ProjectPipeline
+        """
+        token = self.trigger_tokens.get(project_path, trigger)
+        cached = token is not None
+        if not cached:
+            token = self._resolve_trigger_token(project, project_path, trigger)
+        try:
+            return project.trigger_pipeline(ref=branch, token=token, variables=parameters)
+        except gitlab.exceptions.GitlabCreateError as err:
+            if not cached or err.response_code not in (401, 403, 404):
+                raise
+        token = self._resolve_trigger_token(project, project_path, trigger, stale=token)
+        return project.trigger_pipeline(ref=branch, token=token, variables=parameters)
+
+    def _resolve_trigger_token(self, project, project_path, trigger, stale=None):
+        """
+        Cached token of the trigger, looked up or created on GitLab when missing or stale.
+        Serialized per (project, trigger) so concurrent pipelines of a project share one trigger.
+        :param stale: token GitLab rejected
+        :return: token
+        """
+        with self.trigger_tokens.lock(project_path, trigger):
+            token = self.trigger_tokens.get(project_path, trigger)
+            if token is not None and token != stale:
+                # resolved by another worker meanwhile
+                return token
+            token = self._get_or_create_trigger(project, trigger).token
+            self.trigger_tokens.put(project_path, trigger, token)
+            return token
+
+    def run_pipelines(self, pipelines, trigger='Accelerator', max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Trigger many pipelines concurrently
+        :param pipelines: iterable of (namespace, project, branch) or (namespace, project, branch, parameters)
+        :param trigger: trigger description
+        :param max_workers: max pipelines triggered in parallel
+        :return: list of ProjectPipeline in input order, the error in place of failed ones
+        """
+        def run(item):
+            namespace, project_name, branch = item[:3]
+            parameters = item[3] if len(item) > 3 else None
+            project_path = self._form_project_name(namespace, project_name)
+            try:
+                project = self.get_project(namespace, project_name, lazy=True)
+                return self._trigger_pipeline(project, project_path, branch, trigger, parameters)
+            except gitlab.exceptions.GitlabError as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(run, pipelines))
 
     def get_trigger_list(self, namespace, project_name):
         """
@@ -428,15 +2387,20 @@ class GitlabAPI:
         project = self.get_project(namespace, project_name)
         return project.triggers.list()
 
+    @staticmethod
+    def _get_or_create_trigger(project, trigger_description):
+        """Helper"""
+        for t in project.triggers.list(iterator=True):
+            if t.description == trigger_description:
+                return t
+        return project.triggers.create({'description': trigger_description})
+
     def get_or_create_trigger(self, namespace, project_name, trigger_description):
         """
         Create the trigger
         """
-        project = self.get_project(namespace, project_name)
-        for t in project.triggers.list():
-            if t.description == trigger_description:
-                return t
-        return project.triggers.create({'description': trigger_description})
+        project = self.get_project(namespace, project_name, lazy=True)
+        return self._get_or_create_trigger(project, trigger_description)
 
     def merge_mr(self, namespace, project_name, mr_id):
         """
@@ -3,35 +3,488 @@
 @Date: 4-5-2023
 """
 
+import atexit
+import copy
+import functools
+import hashlib
+import hmac
+import json
+import threading
 import time
-from kubernetes import client
+import tracemalloc
+import types
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+from config_manager import ConfigManager
+
+
+DEFAULT_POOL_SIZE = 10
+# longest single watch request, the watch is re-opened from the last resourceVersion
+WATCH_TIMEOUT = 300
+DEFAULT_RESYNC_PERIOD = 600
+DEFAULT_SYNC_TIMEOUT = 60
+DEFAULT_LIST_CHUNK = 500
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CLUSTER_TIMEOUT = 30
+FIELD_MANAGER = "devops-tool-api-clients"
+CONTENT_HASH_ANNOTATION = "devops-tool-api-clients/content-hash"
+# kind -> plural resource name of the core v1 objects that can be applied
+APPLY_RESOURCES = {"ConfigMap": "configmaps", "Secret": "secrets", "ServiceAccount": "serviceaccounts"}
+
+ACCEPT_METADATA_LIST = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1"
+ACCEPT_TABLE = "application/json;as=Table;g=meta.k8s.io;v=v1"
+
+# Compact records built straight from the JSON of list responses
+PodRecord = namedtuple("PodRecord", ["name", "namespace", "labels", "phase", "node", "ready"])
+MetadataRecord = namedtuple("MetadataRecord", ["name", "namespace", "labels", "annotations", "resource_version"])
+# Outcome of an operation on one cluster, latency in seconds
+ClusterResult = namedtuple("ClusterResult", ["cluster", "result", "error", "latency"])
+# Outcome of one object of a rollout, action is applied, unchanged or failed
+RolloutResult = namedtuple("RolloutResult", ["cluster", "kind", "namespace", "name", "action", "error"])
+
+
+class KubernetesClientRegistry:
+    """
+    Long-lived ApiClient per cluster, shared by every KubernetesAPI of that cluster.
+
+    Each ApiClient owns a urllib3 pool whose connections are kept alive between
+    calls, so a warm call never reopens TCP/TLS. Clients are closed on shutdown.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._informers = {}
+
+    @staticmethod
+    def _build(host, port, api_key, ca_cert_path=False, pool_size=DEFAULT_POOL_SIZE):
+        """
+        Creates api client by configuring authentication with given cluster host
+        :return: ApiClient
+        """
+        configuration = client.Configuration()
+        configuration.api_key["authorization"] = api_key
+        configuration.api_key_prefix['authorization'] = 'Bearer'
+        configuration.host = f'https://{host}:{port}'
+        configuration.verify_ssl = bool(ca_cert_path)
+        if ca_cert_path:
+            configuration.ssl_ca_cert = str(ca_cert_path)
+        configuration.connection_pool_maxsize = pool_size
+        return client.ApiClient(configuration)
+
+    def get(self, host, port, api_key, ca_cert_path=False, pool_size=DEFAULT_POOL_SIZE):
+        """
+        Shared api client of the cluster, built on first use.
+        The pool size is fixed by the first caller for a given cluster.
+        :param host:
+        :param port:
+        :param api_key:
+        :param ca_cert_path:
+        :param pool_size: max connections kept alive to the api server
+        :return: ApiClient
+        """
+        key = (host, str(port), api_key)
+        with self._lock:
+            api_client = self._clients.get(key)
+            if api_client is None:
+                api_client = self._build(host, port, api_key, ca_cert_path, pool_size)
+                self._clients[key] = api_client
+            return api_client
+
+    @staticmethod
+    def cluster_config(name):
+        """
+        Settings of the cluster from the kubernetes section of config.yaml
+        :param name: e.g. cluster1
+        :return: dict
+        """
+        clusters = ConfigManager()['kubernetes']
+        if name not in clusters:
+            raise ValueError(f"error: cluster {name} not found in config")
+        return clusters[name]
+
+    @staticmethod
+    def cluster_names():
+        """
+        Clusters defined in config.yaml
+        :return: list of names
+        """
+        return list(ConfigManager()['kubernetes'])
+
+    def for_cluster(self, name, pool_size=None):
+        """
+        Shared api client of a cluster from config.yaml
+        :param name: e.g. cluster1
+        :param pool_size: defaults to the pool-size of the cluster config
+        :return: ApiClient
+        """
+        cfg = self.cluster_config(name)
+        return self.get(cfg['host'], cfg['port'], cfg['api-key'], cfg.get('ca-cert', False),
+                        pool_size or cfg.get('pool-size', DEFAULT_POOL_SIZE))
+
+    @staticmethod
+    def _close(api_client):
+        api_client.close()
+        api_client.rest_client.pool_manager.clear()
+
+    def close_all(self):
+        """
+        Close every client, their pools and connections
+        :return: None
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            informers = list(self._informers.values())
+            self._clients.clear()
+            self._informers.clear()
+        for informer in informers:
+            informer.stop()
+        for api_client in clients:
+            self._close(api_client)
+
+    def informer(self, key, factory):
+        """
+        Shared informer for the key, created and started on first use
+        :param key: e.g. (cluster key, kind, namespace)
+        :param factory: callable building the Informer
+        :return: Informer
+        """
+        with self._lock:
+            informer = self._informers.get(key)
+            if informer is None:
+                informer = factory()
+                informer.start()
+                self._informers[key] = informer
+        return informer
+
+
+def iter_list(list_func, limit=DEFAULT_LIST_CHUNK, **kwargs):
+    """
+    Stream a list call chunk by chunk with limit/continue
+    :param list_func: api list method, e.g. CoreV1Api().list_namespaced_pod
+    :param limit: objects per chunk
+    :param kwargs: arguments of list_func, e.g. namespace, label_selector, field_selector
+    :return: iterator of objects
+    """
+    continue_token = None
+    while True:
+        if continue_token:
+            kwargs["_continue"] = continue_token
+        response = list_func(limit=limit, **kwargs)
+        yield from response.items
+        continue_token = response.metadata._continue
+        if not continue_token:
+            return
+
+
+def index_by_namespace(obj):
+    return [obj.metadata.namespace] if obj.metadata.namespace else []
+
+
+def index_by_label(obj):
+    return [f"{key}={value}" for key, value in (obj.metadata.labels or {}).items()]
+
+
+def index_by_node(obj):
+    node_name = getattr(obj.spec, "node_name", None) if getattr(obj, "spec", None) else None
+    return [node_name] if node_name else []
+
+
+class Informer:
+    """
+    In-memory cache of one resource kind kept up to date with list+watch.
+
+    A background thread lists the objects once, then applies watch events from
+    the list resourceVersion. The whole list is fetched again when the watch
+    expires (410 Gone) and every resync_period to heal any drift. Objects are
+    indexed by the given indexers (index name -> callable returning the index
+    values of an object) and every read is served from memory.
+    """
+
+    def __init__(self, list_func, resync_period=DEFAULT_RESYNC_PERIOD, indexers=None, **list_kwargs):
+        """
+        :param list_func: api list method, e.g. CoreV1Api().list_namespaced_pod
+        :param resync_period: seconds between full relists
+        :param indexers: dict of index name -> callable(obj) -> list of values
+        :param list_kwargs: arguments of list_func, e.g. namespace, label_selector
+        """
+        self.list_func = list_func
+        self.list_kwargs = list_kwargs
+        self.resync_period = resync_period
+        self.indexers = indexers or {"namespace": index_by_namespace, "label": index_by_label}
+        self._lock = threading.RLock()
+        self._store = {}
+        self._indexes = {name: {} for name in self.indexers}
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._watch = None
+        self.resource_version = None
+        self.events = 0
+        self.relists = 0
+        self.errors = 0
+        self.last_sync = None
+        self.last_contact = None
+
+    @staticmethod
+    def key(obj):
+        if obj.metadata.namespace:
+            return f"{obj.metadata.namespace}/{obj.metadata.name}"
+        return obj.metadata.name
+
+    def _index(self, key, obj):
+        for name, indexer in self.indexers.items():
+            for value in indexer(obj):
+                self._indexes[name].setdefault(value, set()).add(key)
+
+    def _unindex(self, key, obj):
+        for name, indexer in self.indexers.items():
+            for value in indexer(obj):
+                keys = self._indexes[name].get(value)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self._indexes[name][value]
+
+    def _relist(self):
+        """
+        Replace the store with a fresh list
+        :return: None
+        """
+        response = self.list_func(**self.list_kwargs)
+        store = {self.key(obj): obj for obj in response.items}
+        with self._lock:
+            self._store = store
+            self._indexes = {name: {} for name in self.indexers}
+            for key, obj in store.items():
+                self._index(key, obj)
+            self.resource_version = response.metadata.resource_version
+            self.relists += 1
+            self.last_sync = self.last_contact = time.monotonic()
+        self._synced.set()
+
+    def _apply(self, event_type, obj):
+        key = self.key(obj)
+        with self._lock:
+            old = self._store.pop(key, None)
+            if old is not None:
+                self._unindex(key, old)
+            if event_type != "DELETED":
+                self._store[key] = obj
+                self._index(key, obj)
+            self.events += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self.resource_version is None or time.monotonic() - self.last_sync >= self.resync_period:
+                    self._relist()
+                until_resync = self.resync_period - (time.monotonic() - self.last_sync)
+                self._watch = watch.Watch()
+                for event in self._watch.stream(self.list_func, resource_version=self.resource_version,
+                                                allow_watch_bookmarks=True,
+                                                timeout_seconds=max(1, int(min(WATCH_TIMEOUT, until_resync))),
+                                                **self.list_kwargs):
+                    obj = event["object"]
+                    self.resource_version = obj.metadata.resource_version
+                    self.last_contact = time.monotonic()
+                    if event["type"] != "BOOKMARK":
+                        self._apply(event["type"], obj)
+                    if self._stopped.is_set():
+                        break
+            except ApiException as e:
+                if e.status != 410:
+                    self.errors += 1
+                    print(f"error: informer watch failed: {e}")
+                    self._stopped.wait(1)
+                # relist on 410 Gone or after an error
+                self.resource_version = None
+            except Exception as e:
+                self.errors += 1
+                print(f"error: informer watch failed: {e}")
+                self.resource_version = None
+                self._stopped.wait(1)
+
+    def start(self):
+        """
+        Start the background list+watch
+        :return: self
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="informer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch:
+            self._watch.stop()
+
+    def wait_for_sync(self, timeout=DEFAULT_SYNC_TIMEOUT):
+        """
+        Wait for the first list to be loaded
+        :param timeout: seconds
+        :return: True when synced
+        """
+        return self._synced.wait(timeout)
+
+    def get(self, name, namespace=None):
+        with self._lock:
+            return self._store.get(f"{namespace}/{name}" if namespace else name)
+
+    def list(self):
+        with self._lock:
+            return list(self._store.values())
+
+    def by_index(self, index_name, value):
+        """
+        Objects having value in the index
+        :param index_name: e.g. namespace, label (value "app=web") or node
+        :param value:
+        :return: list of objects
+        """
+        with self._lock:
+            return [self._store[key] for key in self._indexes[index_name].get(value, ())]
+
+    def select(self, **criteria):
+        """
+        Objects matching every index criteria, e.g. select(namespace="dev", label="app=web")
+        :return: list of objects
+        """
+        with self._lock:
+            keys = None
+            for index_name, value in criteria.items():
+                matched = self._indexes[index_name].get(value, set())
+                keys = set(matched) if keys is None else keys & matched
+            if keys is None:
+                return list(self._store.values())
+            return [self._store[key] for key in keys]
+
+    def metrics(self):
+        """
+        Cache metrics, staleness is the time since the last list or watch event
+        :return: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "objects": len(self._store),
+                "events": self.events,
+                "relists": self.relists,
+                "errors": self.errors,
+                "synced": self._synced.is_set(),
+                "staleness_seconds": now - self.last_contact if self.last_contact else None,
+                "since_last_sync_seconds": now - self.last_sync if self.last_sync else None,
+            }
+
+
+def pod_record(item):
+    """
+    PodRecord of a pod as decoded from JSON
+    :param item: dict
+    :return: PodRecord
+    """
+    metadata = item["metadata"]
+    status = item.get("status", {})
+    ready = any(c.get("type") == "Ready" and c.get("status") == "True" for c in status.get("conditions", ()))
+    return PodRecord(metadata["name"], metadata.get("namespace"), metadata.get("labels", {}),
+                     status.get("phase"), item.get("spec", {}).get("nodeName"), ready)
+
+
+def metadata_record(item):
+    """
+    MetadataRecord of any object as decoded from JSON
+    :param item: dict
+    :return: MetadataRecord
+    """
+    metadata = item["metadata"]
+    return MetadataRecord(metadata["name"], metadata.get("namespace"), metadata.get("labels", {}),
+                          metadata.get("annotations", {}), metadata.get("resourceVersion"))
+
+
+registry = KubernetesClientRegistry()
+atexit.register(registry.close_all)
+
+
+class _RequestTimeoutApi:
+    """
+    Proxy of a kubernetes api object passing _request_timeout to every call
+    """
+
+    def __init__(self, api, timeout):
+        self._api = api
+        self._timeout = timeout
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        # wraps keeps the docstring, watch.Watch reads the return type from it
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            kwargs.setdefault("_request_timeout", self._timeout)
+            return attr(*args, **kwargs)
+        return call
+
 
 class KubernetesAPI:
 
-    def __init__(self, host, port, api_key, ca_cert_path=False):
+    def __init__(self, host, port, api_key, ca_cert_path=False, pool_size=DEFAULT_POOL_SIZE):
         """
         Initialization
         :param host:
         :param port:
         :param api_key:
+        :param ca_cert_path: CA bundle of the api server, TLS is not verified without it
+        :param pool_size: max connections kept alive to the api server
         """
         self.host = host
         self.port = port
         self.api_key = api_key
         self.ca_cert_path = ca_cert_path
-        self.configuration = client.Configuration()
+        self.pool_size = pool_size
+        self.cluster = None
+        self.request_timeout = None
+        self.api_client = registry.get(host, port, api_key, ca_cert_path, pool_size)
+        self.configuration = self.api_client.configuration
+        self._core = client.CoreV1Api(self.api_client)
+
+    @classmethod
+    def from_cluster(cls, name, pool_size=None):
+        """
+        Client of a cluster from the kubernetes section of config.yaml
+        :param name: e.g. cluster1
+        :param pool_size: defaults to the pool-size of the cluster config
+        :return: KubernetesAPI
+        """
+        cfg = registry.cluster_config(name)
+        api = cls(cfg['host'], cfg['port'], cfg['api-key'], cfg.get('ca-cert', False),
+                  pool_size or cfg.get('pool-size', DEFAULT_POOL_SIZE))
+        api.cluster = name
+        return api
+
+    def with_request_timeout(self, timeout):
+        """
+        Copy of the client whose api calls give up after timeout seconds
+        :param timeout: seconds
+        :return: KubernetesAPI
+        """
+        api = copy.copy(self)
+        api.request_timeout = timeout
+        api._core = _RequestTimeoutApi(self._core, timeout)
+        return api
 
     def get_client(self):
         """
-        Creates api client by configuring authentication with given cluster host
+        Core v1 api on the shared client of the cluster
         :return:
         """
-        self.configuration.api_key["authorization"] = self.api_key
-        self.configuration.api_key_prefix['authorization'] = 'Bearer'
-        self.configuration.host = f'https://{self.host}:{self.port}'
-        self.configuration.verify_ssl = False
-        # self.configuration.ssl_ca_cert = Path(self.ca_cert_path)
-        return client.CoreV1Api(client.ApiClient(self.configuration))
+        return self._core
 
     def get_pod_list(self, namespace):
         """
@@ -42,14 +495,136 @@ class KubernetesAPI:
         response = self.get_client().list_namespaced_pod(namespace=namespace)
         return response
 
+    @staticmethod
+    def _selectors(label_selector, field_selector):
+        """Helper"""
+        return {name: value for name, value in
+                (("label_selector", label_selector), ("field_selector", field_selector)) if value}
+
+    def iter_pods(self, namespace, label_selector=None, field_selector=None, limit=DEFAULT_LIST_CHUNK):
+        """
+        Stream the pods of the namespace in chunks, filtered on the server
+        :param namespace:
+        :param label_selector: e.g. app=web
+        :param field_selector: e.g. status.phase=Running
+        :param limit: pods per chunk
+        :return: iterator of V1Pod
+        """
+        return iter_list(self.get_client().list_namespaced_pod, limit=limit, namespace=namespace,
+                         **self._selectors(label_selector, field_selector))
+
+    def iter_config_maps(self, namespace, label_selector=None, field_selector=None, limit=DEFAULT_LIST_CHUNK):
+        """
+        Stream the configmaps of the namespace in chunks, filtered on the server
+        :param namespace:
+        :param label_selector:
+        :param field_selector: e.g. metadata.name=my-config
+        :param limit: configmaps per chunk
+        :return: iterator of V1ConfigMap
+        """
+        return iter_list(self.get_client().list_namespaced_config_map, limit=limit, namespace=namespace,
+                         **self._selectors(label_selector, field_selector))
+
+    def _get_json(self, path, accept="application/json", **query):
+        """
+        GET on the api server without model deserialization
+        :param path: e.g. /api/v1/namespaces/dev/pods
+        :param accept: Accept header, selects metadata-only or table responses
+        :param query: query parameters
+        :return: decoded JSON
+        """
+        response = self.api_client.call_api(
+            path, "GET",
+            query_params=[(name, value) for name, value in query.items() if value is not None],
+            header_params={"Accept": accept},
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+            _preload_content=False,
+            _request_timeout=self.request_timeout,
+        )
+        return json.loads(response.data)
+
+    def _iter_json(self, path, accept, limit, **query):
+        """
+        Stream the items of a raw list call chunk by chunk with limit/continue
+        :return: iterator of dicts
+        """
+        continue_token = None
+        while True:
+            body = self._get_json(path, accept, limit=limit, labelSelector=query.get("label_selector"),
+                                  fieldSelector=query.get("field_selector"), **{"continue": continue_token})
+            yield from body.get("items", ())
+            continue_token = body["metadata"].get("continue")
+            if not continue_token:
+                return
+
+    @staticmethod
+    def _collection_path(resource, namespace=None):
+        """Helper"""
+        if namespace:
+            return f"/api/v1/namespaces/{namespace}/{resource}"
+        return f"/api/v1/{resource}"
+
+    def iter_pod_records(self, namespace=None, label_selector=None, field_selector=None, limit=DEFAULT_LIST_CHUNK):
+        """
+        Stream pods as PodRecord tuples, parsed from JSON without the kubernetes models
+        :param namespace: all namespaces when None
+        :param label_selector:
+        :param field_selector:
+        :param limit: pods per chunk
+        :return: iterator of PodRecord
+        """
+        for item in self._iter_json(self._collection_path("pods", namespace), "application/json", limit,
+                                    label_selector=label_selector, field_selector=field_selector):
+            yield pod_record(item)
+
+    def iter_metadata(self, resource, namespace=None, label_selector=None, field_selector=None,
+                      limit=DEFAULT_LIST_CHUNK):
+        """
+        Stream only the metadata (PartialObjectMetadata) of a core v1 resource
+        :param resource: plural name, e.g. pods, configmaps, secrets
+        :param namespace: all namespaces when None
+        :param label_selector:
+        :param field_selector:
+        :param limit: objects per chunk
+        :return: iterator of MetadataRecord
+        """
+        for item in self._iter_json(self._collection_path(resource, namespace), ACCEPT_METADATA_LIST, limit,
+                                    label_selector=label_selector, field_selector=field_selector):
+            yield metadata_record(item)
+
+    def get_table(self, resource, namespace=None, label_selector=None):
+        """
+        Server-side printed columns of a core v1 resource, as kubectl get shows them
+        :param resource: plural name, e.g. pods
+        :param namespace: all namespaces when None
+        :param label_selector:
+        :return: (column names, rows of cells)
+        """
+        body = self._get_json(self._collection_path(resource, namespace), ACCEPT_TABLE,
+                              labelSelector=label_selector, includeObject="None")
+        columns = [column["name"] for column in body.get("columnDefinitions", ())]
+        return columns, [row["cells"] for row in body.get("rows", ())]
+
+    def iter_namespaces(self, label_selector=None, field_selector=None, limit=DEFAULT_LIST_CHUNK):
+        """
+        Stream the namespaces in chunks, filtered on the server
+        :param label_selector:
+        :param field_selector:
+        :param limit: namespaces per chunk
+        :return: iterator of V1Namespace
+        """
+        return iter_list(self.get_client().list_namespace, limit=limit,
+                         **self._selectors(label_selector, field_selector))
+
     def get_config_map(self, name, namespace):
         response = self.get_client().read_namespaced_config_map(name=name, namespace=namespace)
         return response.data
 
     @staticmethod
-    def create_configmap_object(dict_content):
+    def create_configmap_object(dict_content, name="saas-framework-all", namespace="saas-framework"):
         # Configureate ConfigMap metadata
-        metadata = client.V1ObjectMeta(name="saas-framework-all", namespace="saas-framework")
+        metadata = client.V1ObjectMeta(name=name, namespace=namespace)
         # Instantiate the configmap object
         configmap = client.V1ConfigMap(
             api_version="v1",
@@ -61,24 +636,161 @@ class KubernetesAPI:
 
     def create_or_update_config_map(self, **kwargs):
         """
+        Create the configmap or update it in place, with a single server-side apply
+        :param name:
+        :param namespace:
+        :param data: configmap data (dict_content is accepted too)
+        :return: applied configmap as a dict
+        """
+        data = kwargs.get("data", kwargs.get("dict_content"))
+        return self.apply_config_map(kwargs.get("name"), kwargs.get("namespace"), data)
+
+    def apply(self, manifest, field_manager=FIELD_MANAGER, force=True):
+        """
+        Server-side apply of a core v1 object: one request creates or updates it
+        :param manifest: object as a dict with apiVersion, kind and metadata name/namespace
+        :param field_manager: owner of the applied fields
+        :param force: take over fields owned by other managers
+        :return: applied object as a dict
+        """
+        metadata = manifest["metadata"]
+        path = f"/api/v1/namespaces/{metadata['namespace']}/{APPLY_RESOURCES[manifest['kind']]}/{metadata['name']}"
+        response = self.api_client.call_api(
+            path, "PATCH",
+            query_params=[("fieldManager", field_manager), ("force", "true" if force else "false")],
+            header_params={"Content-Type": "application/apply-patch+yaml", "Accept": "application/json"},
+            body=manifest,
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+            _preload_content=False,
+            _request_timeout=self.request_timeout,
+        )
+        return json.loads(response.data)
+
+    def content_hash(self, content, labels=None):
+        """
+        Stable hash of the object content and labels, recorded as an annotation to skip
+        unchanged rollouts. It is an HMAC keyed with the cluster token so that secret
+        values cannot be guessed from the annotation by anyone reading metadata.
+        :param content: dict
+        :param labels: dict
+        :return: hex digest
+        """
+        payload = json.dumps({"content": content, "labels": labels or {}}, sort_keys=True).encode()
+        return hmac.new(str(self.api_key).encode(), payload, hashlib.sha256).hexdigest()
 
+    @staticmethod
+    def _manifest(kind, name, namespace, content, annotations=None, labels=None):
+        """Helper"""
+        metadata = {"name": name, "namespace": namespace}
+        if annotations:
+            metadata["annotations"] = annotations
+        if labels:
+            metadata["labels"] = labels
+        return dict({"apiVersion": "v1", "kind": kind, "metadata": metadata}, **content)
+
+    def apply_config_map(self, name, namespace, data, labels=None):
+        """
+        Create or update the configmap with server-side apply
+        :param name:
         :param namespace:
-        :param body:
-        :return:
+        :param data: dict of str
+        :param labels:
+        :return: applied configmap as a dict
         """
-        namespace = kwargs.get("namespace")
-        config_map = k8s.create_configmap_object(**kwargs)
-        response = self.get_client().list_namespaced_config_map(namespace=namespace)
+        content = {"data": data or {}}
+        annotations = {CONTENT_HASH_ANNOTATION: self.content_hash(content, labels)}
+        return self.apply(self._manifest("ConfigMap", name, namespace, content, annotations, labels))
 
-        found = False
-        for cm in response.to_dict()['items']:
-            if cm['name'] == kwargs.get("name"):
-                found = True
+    def apply_secret(self, name, namespace, data=None, string_data=None, secret_type="Opaque", labels=None):
+        """
+        Create or update the secret with server-side apply
+        :param name:
+        :param namespace:
+        :param data: dict of base64 encoded values
+        :param string_data: dict of plain values
+        :param secret_type:
+        :param labels:
+        :return: applied secret as a dict
+        """
+        content = {"type": secret_type}
+        if data:
+            content["data"] = data
+        if string_data:
+            content["stringData"] = string_data
+        annotations = {CONTENT_HASH_ANNOTATION: self.content_hash(content, labels)}
+        return self.apply(self._manifest("Secret", name, namespace, content, annotations, labels))
 
-        if not found:
-            self.get_client().create_namespaced_config_map(namespace=namespace, body=config_map)
-        else:
-            self.get_client().patch_namespaced_config_map(name=namespace, namespace=namespace, body=config_map)
+    def apply_service_account(self, namespace, name, labels=None):
+        """
+        Create or update the service account with server-side apply
+        :param namespace:
+        :param name:
+        :param labels:
+        :return: applied service account as a dict
+        """
+        return self.apply(self._manifest("ServiceAccount", name, namespace, {}, labels=labels))
+
+    @staticmethod
+    def _rollout_content(obj):
+        """Helper, content of a rollout object as it is applied"""
+        if obj["kind"] == "Secret":
+            content = {"type": obj.get("type", "Opaque")}
+            if obj.get("data"):
+                content["data"] = obj["data"]
+            if obj.get("string_data"):
+                content["stringData"] = obj["string_data"]
+            return content
+        return {"data": obj.get("data") or {}}
+
+    def rollout(self, objects, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Apply many configmaps/secrets across namespaces and clusters concurrently.
+        The content hash annotations of each (cluster, kind, namespace) are read
+        once with a metadata-only list, objects whose hash did not change are skipped.
+        :param objects: list of dicts with kind (ConfigMap or Secret), name, namespace,
+                        data (and string_data, type for secrets), optional labels and
+                        cluster from config.yaml (this client's cluster when missing)
+        :param max_workers: max requests in parallel
+        :return: list of RolloutResult in input order
+        """
+        clients = {None: self}
+        for obj in objects:
+            if obj.get("cluster") and obj["cluster"] not in clients:
+                clients[obj["cluster"]] = KubernetesAPI.from_cluster(obj["cluster"])
+
+        def known_hashes(group):
+            cluster, kind, namespace = group
+            return {
+                record.name: record.annotations.get(CONTENT_HASH_ANNOTATION)
+                for record in clients[cluster].iter_metadata(APPLY_RESOURCES[kind], namespace)
+            }
+
+        def apply_object(obj):
+            cluster = obj.get("cluster")
+            group = (cluster, obj["kind"], obj["namespace"])
+            content = self._rollout_content(obj)
+            digest = clients[cluster].content_hash(content, obj.get("labels"))
+            try:
+                if hashes[group].get(obj["name"]) == digest:
+                    return RolloutResult(cluster, obj["kind"], obj["namespace"], obj["name"], "unchanged", None)
+                manifest = self._manifest(obj["kind"], obj["name"], obj["namespace"], content,
+                                          {CONTENT_HASH_ANNOTATION: digest}, obj.get("labels"))
+                clients[cluster].apply(manifest)
+            except Exception as e:
+                return RolloutResult(cluster, obj["kind"], obj["namespace"], obj["name"], "failed", e)
+            return RolloutResult(cluster, obj["kind"], obj["namespace"], obj["name"], "applied", None)
+
+        groups = list({(obj.get("cluster"), obj["kind"], obj["namespace"]) for obj in objects})
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = {}
+            for group, future in zip(groups, [executor.submit(known_hashes, group) for group in groups]):
+                try:
+                    hashes[group] = future.result()
+                except Exception:
+                    # no hashes known, every object of the group is applied
+                    hashes[group] = {}
+            return list(executor.map(apply_object, objects))
 
     def list_namespaces(self):
         """
@@ -87,6 +799,61 @@ class KubernetesAPI:
         """
         response = self.get_client().list_namespace()
         return response
+
+    def informer(self, kind, namespace=None, resync_period=DEFAULT_RESYNC_PERIOD, sync_timeout=DEFAULT_SYNC_TIMEOUT):
+        """
+        Shared, started informer of the cluster for pods, configmaps or namespaces
+        :param kind: pods, configmaps or namespaces
+        :param namespace: watch a single namespace, all namespaces when None
+        :param resync_period: seconds between full relists
+        :param sync_timeout: seconds to wait for the first list
+        :return: Informer, synced, raises TimeoutError when the first list did not load in time
+        """
+        core = self.get_client()
+        indexers = {"namespace": index_by_namespace, "label": index_by_label}
+        if kind == "pods":
+            indexers["node"] = index_by_node
+            list_func = core.list_namespaced_pod if namespace else core.list_pod_for_all_namespaces
+        elif kind == "configmaps":
+            list_func = core.list_namespaced_config_map if namespace else core.list_config_map_for_all_namespaces
+        elif kind == "namespaces":
+            list_func, namespace = core.list_namespace, None
+        else:
+            raise ValueError(f"error: no informer for {kind}")
+        list_kwargs = {"namespace": namespace} if namespace else {}
+        key = (self.host, str(self.port), self.api_key, kind, namespace)
+        informer = registry.informer(
+            key, lambda: Informer(list_func, resync_period=resync_period, indexers=indexers, **list_kwargs))
+        if not informer.wait_for_sync(sync_timeout):
+            raise TimeoutError(f"error: {kind} informer of {self.host} not synced after {sync_timeout}s")
+        return informer
+
+    def list_cached_pods(self, namespace=None, label=None, node=None):
+        """
+        Pods served from the informer cache
+        :param namespace:
+        :param label: "key=value"
+        :param node: node name
+        :return: list of V1Pod
+        """
+        criteria = {name: value for name, value in (("namespace", namespace), ("label", label), ("node", node))
+                    if value}
+        return self.informer("pods").select(**criteria)
+
+    def get_cached_config_map(self, name, namespace):
+        """
+        Configmap data served from the informer cache
+        :return: dict or None when the configmap does not exist
+        """
+        config_map = self.informer("configmaps").get(name, namespace)
+        return config_map.data if config_map else None
+
+    def list_cached_namespaces(self):
+        """
+        Namespaces served from the informer cache
+        :return: list of V1Namespace
+        """
+        return self.informer("namespaces").list()
     
     def create_service_account(self, namespace, name):
         """
@@ -114,41 +881,232 @@ class KubernetesAPI:
         response = self.get_client().create_namespaced_secret(namespace=namespace, body=body)
         return response
 
-    def get_pod_status(self, namespace):
+    @staticmethod
+    def _pod_ready(pod):
+        """Helper, pod has the Ready condition"""
+        for condition in pod.status.conditions or []:
+            if condition.type == "Ready":
+                return condition.status == "True"
+        return False
+
+    @staticmethod
+    def _pod_restarts(pod):
+        """Helper, container restarts of the pod"""
+        return sum(status.restart_count for status in pod.status.container_statuses or [])
 
-        total_pods = 0
-        running_pods = 0
-        pod_statuses = []
+    def _pods_state(self, pods, condition, max_restarts):
+        """
+        Evaluate the wait condition on the known pods
+        :return: dict
+        """
+        pending = []
+        restarts_exceeded = []
+        for pod in pods.values():
+            if condition == "ready":
+                satisfied = self._pod_ready(pod)
+            else:
+                satisfied = pod.status.phase == "Running"
+            if not satisfied:
+                pending.append({"name": pod.metadata.name, "status": pod.status.phase})
+            if max_restarts is not None and self._pod_restarts(pod) > max_restarts:
+                restarts_exceeded.append({"name": pod.metadata.name, "restarts": self._pod_restarts(pod)})
+        return {
+            "satisfied": not pending,
+            "pod_statuses": pending,
+            "restarts_exceeded": restarts_exceeded,
+            "timed_out": False,
+        }
 
+    def wait_for_pods(self, namespace, condition="running", timeout=None, label_selector=None,
+                      field_selector=None, max_restarts=None):
+        """
+        Wait until every selected pod meets the condition, driven by watch events.
+        The pods are listed once, then watched from the resourceVersion of that
+        list; the list is only repeated when the watch expires (410 Gone).
+        :param namespace:
+        :param condition: running (phase Running) or ready (Ready condition true)
+        :param timeout: seconds, None to wait forever
+        :param label_selector:
+        :param field_selector:
+        :param max_restarts: stop waiting as soon as a pod restarted more often than this
+        :return: {"satisfied": bool, "pod_statuses": [...], "restarts_exceeded": [...], "timed_out": bool}
+        """
+        core = self.get_client()
+        selectors = {name: value for name, value in
+                     (("label_selector", label_selector), ("field_selector", field_selector)) if value}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pods = {}
+        resource_version = None
         while True:
+            if resource_version is None:
+                pod_list = core.list_namespaced_pod(namespace=namespace, **selectors)
+                pods = {pod.metadata.name: pod for pod in pod_list.items}
+                resource_version = pod_list.metadata.resource_version
+            state = self._pods_state(pods, condition, max_restarts)
+            if state["satisfied"] or state["restarts_exceeded"]:
+                return state
+            remaining = WATCH_TIMEOUT if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                state["timed_out"] = True
+                return state
+            w = watch.Watch()
             try:
-                # Get list of pods in the namespace
-                pods = self.get_client().list_namespaced_pod(namespace=namespace)
-
-                # Reset counts
-                total_pods = len(pods.items)
-                running_pods = 0
-                pod_statuses.clear()
-
-                for pod in pods.items:
-                    # Check if the pod is running
-                    if pod.status.phase == "Running":
-                        running_pods += 1
+                for event in w.stream(core.list_namespaced_pod, namespace=namespace,
+                                      resource_version=resource_version, allow_watch_bookmarks=True,
+                                      timeout_seconds=max(1, int(min(remaining, WATCH_TIMEOUT))), **selectors):
+                    pod = event["object"]
+                    resource_version = pod.metadata.resource_version
+                    if event["type"] == "BOOKMARK":
+                        continue
+                    if event["type"] == "DELETED":
+                        pods.pop(pod.metadata.name, None)
                     else:
-                        pod_statuses.append({"name": pod.metadata.name, "status": pod.status.phase})
+                        pods[pod.metadata.name] = pod
+                    state = self._pods_state(pods, condition, max_restarts)
+                    if state["satisfied"] or state["restarts_exceeded"]:
+                        w.stop()
+                        return state
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+                # the resourceVersion is too old, list again
+                resource_version = None
 
-                if running_pods == total_pods:
-                    return {"all_running": True, "pod_statuses": pod_statuses}
+    def get_pod_status(self, namespace, timeout=None, label_selector=None):
+        """
+        Wait until all the pods of the namespace are running
+        :param namespace:
+        :param timeout: seconds, None to wait forever
+        :param label_selector:
+        :return: {"all_running": bool, "pod_statuses": [pods not running]}
+        """
+        try:
+            state = self.wait_for_pods(namespace, condition="running", timeout=timeout,
+                                       label_selector=label_selector)
+            return {"all_running": state["satisfied"], "pod_statuses": state["pod_statuses"]}
+        except Exception as e:
+            return {"error": f"Error occurred while fetching pod status: {e}"}
 
-                # Wait for a few seconds before checking again
-                time.sleep(1)
 
-            except Exception as e:
-                return {"error": f"Error occurred while fetching pod status: {e}"}
+class MultiClusterKubernetesAPI:
+    """
+    Runs the same read operation on many clusters of config.yaml concurrently.
+
+    Results are streamed as clusters answer, so a slow or unreachable cluster
+    never holds the others back; it is reported with a TimeoutError once its
+    timeout expires, and its api calls carry the same timeout so the abandoned
+    thread ends too. The latency of the last call is kept per cluster.
+
+        clusters = MultiClusterKubernetesAPI()
+        for res in clusters.run("get_pod_status", namespace="dev", timeout=10, cluster_timeout=15):
+            print(res.cluster, res.latency, res.error or res.result)
+    """
+
+    def __init__(self, clusters=None, timeout=DEFAULT_CLUSTER_TIMEOUT):
+        """
+        :param clusters: cluster names from config.yaml, all of them by default
+        :param timeout: default per-cluster timeout in seconds
+        """
+        self.clusters = list(clusters or registry.cluster_names())
+        self.timeout = timeout
+        self.apis = {name: KubernetesAPI.from_cluster(name) for name in self.clusters}
+        self.latencies = {}
+
+    def run(self, operation, *args, clusters=None, cluster_timeout=None, **kwargs):
+        """
+        Run the operation on the clusters in parallel
+        :param operation: KubernetesAPI method name, or callable taking the KubernetesAPI first
+        :param args: arguments of the operation
+        :param clusters: subset of the clusters, all by default
+        :param cluster_timeout: per-cluster timeout in seconds, also the timeout of each api call
+        :param kwargs: keyword arguments of the operation, timeout included
+        :return: iterator of ClusterResult in completion order
+        """
+        clusters = list(clusters or self.clusters)
+        timeout = cluster_timeout or self.timeout
+
+        def call(name):
+            api = self.apis[name].with_request_timeout(timeout)
+            if isinstance(operation, str):
+                result = getattr(api, operation)(*args, **kwargs)
+            else:
+                result = operation(api, *args, **kwargs)
+            # generators (iter_pods, ...) are consumed here so the cluster is read in parallel
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return result
+
+        executor = ThreadPoolExecutor(max_workers=len(clusters) or 1)
+        started = time.monotonic()
+        futures = {executor.submit(call, name): name for name in clusters}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                name = futures.pop(future)
+                latency = time.monotonic() - started
+                self.latencies[name] = latency
+                try:
+                    yield ClusterResult(name, future.result(), None, latency)
+                except Exception as e:
+                    yield ClusterResult(name, None, e, latency)
+        except FutureTimeoutError:
+            for future, name in futures.items():
+                future.cancel()
+                self.latencies[name] = timeout
+                yield ClusterResult(name, None, TimeoutError(f"error: cluster {name} timed out after {timeout}s"),
+                                    timeout)
+        finally:
+            # do not wait for clusters that did not answer in time
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def merged(self, operation, *args, clusters=None, cluster_timeout=None, **kwargs):
+        """
+        Run an operation returning many items and stream every item tagged with its cluster
+        :return: iterator of ClusterResult, one per item, one with the error for failed clusters
+        """
+        for res in self.run(operation, *args, clusters=clusters, cluster_timeout=cluster_timeout, **kwargs):
+            if res.error is not None:
+                yield res
+                continue
+            for item in res.result:
+                yield ClusterResult(res.cluster, item, None, res.latency)
+
+
+def benchmark_pod_reads(k8s, namespace, rounds=3):
+    """
+    Compare CPU time and peak Python memory of the pod read paths.
+    CPU is timed without tracemalloc, whose overhead grows with the number of
+    allocations; the peak comes from one extra traced run.
+    :param k8s: KubernetesAPI
+    :param namespace:
+    :param rounds: timed runs per path, the best one is kept
+    :return: dict of path -> {"cpu_seconds", "peak_bytes", "pods"}
+    """
+    paths = {
+        "models": lambda: k8s.get_pod_list(namespace).items,
+        "records": lambda: list(k8s.iter_pod_records(namespace)),
+        "metadata": lambda: list(k8s.iter_metadata("pods", namespace)),
+    }
+    results = {}
+    for name, read in paths.items():
+        cpu = None
+        for _ in range(rounds):
+            started = time.process_time()
+            count = len(read())
+            elapsed = time.process_time() - started
+            cpu = elapsed if cpu is None else min(cpu, elapsed)
+        tracemalloc.start()
+        try:
+            read()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results[name] = {"cpu_seconds": cpu, "peak_bytes": peak, "pods": count}
+    return results
 
 
 if __name__ == '__main__':
     # driver
     k8s = KubernetesAPI('api-server-ip', 'api-port', 'api-key')
     st = k8s.get_pod_status(namespace='dev')
-    print(st)
\ No newline at end of file
+    print(st)
+    print(benchmark_pod_reads(k8s, namespace='dev'))
\ No newline at end of file
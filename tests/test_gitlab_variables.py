@@ -0,0 +1,62 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("gitlab")
+pytest.importorskip("yaml")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "api-clients"))
+
+from gitlab_api import GitlabAPI, VariableChange  # noqa: E402
+
+
+def variable(key, value, environment_scope="*", protected=False, masked=False):
+    return SimpleNamespace(key=key, value=value, environment_scope=environment_scope, protected=protected,
+                           masked=masked)
+
+
+class RecordingVariables:
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def update(self, key, data, **kwargs):
+        self.calls.append((key, data, kwargs))
+        if self.error:
+            raise self.error
+
+
+def test_plan_update_always_sends_value_and_scope():
+    plan = GitlabAPI.plan_project_variables(
+        [variable("A", "x")], [{"key": "A", "value": "x", "protected": True}])
+
+    assert plan == [VariableChange("update", "A", "*", {"protected": True, "value": "x", "environment_scope": "*"})]
+
+
+def test_plan_unchanged_variable():
+    plan = GitlabAPI.plan_project_variables([variable("A", "x")], [{"key": "A", "value": "x"}])
+
+    assert plan == [VariableChange("unchanged", "A", "*", {})]
+
+
+def test_apply_update_passes_value():
+    variables = RecordingVariables()
+    change = VariableChange("update", "A", "*", {"protected": True, "value": "x", "environment_scope": "*"})
+
+    result = GitlabAPI._apply_variable_change(SimpleNamespace(variables=variables), change)
+
+    assert result.ok
+    assert variables.calls == [("A", change.data, {"filter": {"environment_scope": "*"}})]
+
+
+def test_apply_reports_any_error():
+    error = AttributeError("Missing attributes: value")
+    project = SimpleNamespace(variables=RecordingVariables(error))
+
+    result = GitlabAPI._apply_variable_change(project, VariableChange("update", "A", "*", {"protected": True}))
+
+    assert not result.ok
+    assert result.error is error